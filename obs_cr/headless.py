@@ -35,6 +35,8 @@ def main():
                         help="Preset commands to run for resizing windows.  Choose one of: 'zoomw' (zoom workplace - this is probably what you want) or 'zoom' (old classic zoom).  The exact commands are set in config.yaml")
                         #help="Command to run when setting resolution.  WIDTH and HEIGHT will be replaced with integers.  Example: \"xdotool search --onlyvisible --name '^Zoom$' windowsize WIDTH HEIGHT;\" (mind the nested quotes)")
     parser.add_argument('--broadcaster', action='store_true', help="This is running on broadcaster's computer.  Enable extra broadcaster functionality like unmuting and controlling Zoom.")
+    parser.add_argument('--slow-watcher', type=float, default=1.0, metavar='SECONDS',
+                        help="Warn about watchers (like resolution changes) taking longer than this, default=%(default)s")
     parser.add_argument('--verbose', '-v', action='count', default=0)
     args = cli_args = parser.parse_args()
 
@@ -71,7 +73,9 @@ def main():
         obssubscribe = getattr(obsreq, 'callback.register')
         cl = type('null', (), {'callback':type('null', (), {'register': lambda *args, **kwargs: None})})
 
-    obs = ObsState(obsreq, cl, config=CONFIG, test=args.test)
+    # Only the latest resolution matters if several arrive while resizing.
+    obs = ObsState(obsreq, cl, config=CONFIG, test=args.test, slow_watcher=args.slow_watcher,
+                   watcher_policies={'ss_resolution': 'latest', 'mainwindow_resolution': 'latest'})
 
 
     # Other watchers (not displayed on the control panel)
@@ -86,6 +90,9 @@ def main():
     print('connected, waiting...')
     while True:
         time.sleep(3600)
+        for name, stats in sorted(dict(obs._dispatcher.stats).items()):
+            LOG.info("Watcher %s: %d runs, %.3f s total, %.3f s max, %.3f s max delay",
+                     name, stats['runs'], stats['total'], stats['max'], stats['max_delay'])
 
 
 def notes_scroll(value):
@@ -0,0 +1,18 @@
+"""obs-websocket v5 authentication, for both ends of a connection."""
+
+import base64
+import hashlib
+import hmac
+
+
+def obs_auth(password, salt, challenge):
+    """Compute the obs-websocket v5 authentication string for a Hello"""
+    secret = base64.b64encode(hashlib.sha256((password + salt).encode()).digest())
+    return base64.b64encode(hashlib.sha256(secret + challenge.encode()).digest()).decode()
+
+
+def check_auth(authentication, password, salt, challenge):
+    """Whether a client's Identify authentication is right, compared in constant time"""
+    if not isinstance(authentication, str):
+        return False
+    return hmac.compare_digest(authentication.encode(), obs_auth(password, salt, challenge).encode())
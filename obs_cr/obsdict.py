@@ -1,6 +1,108 @@
+import atexit
 import collections
+import concurrent.futures
+import functools
 import inspect
+import itertools
+import json
 import logging
+import threading
+import time
+
+REALM = 'OBS_WEBSOCKET_DATA_REALM_PROFILE'
+
+
+class LockedClient:
+    """Wrapper of an obsws_python ReqClient which can be used from several threads.
+
+    ReqClient sends a request and reads the response on its one
+    websocket, so requests from two threads at once could get each
+    other's responses.  Calls of the wrapper take `lock` for that.
+    """
+    def __init__(self, client):
+        self._client = client
+        self.lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        @functools.wraps(attr)
+        def locked(*args, **kwargs):
+            with self.lock:
+                return attr(*args, **kwargs)
+        return locked
+
+
+class WatcherDispatcher:
+    """Runs watchers on a pool of threads, in order for each key.
+
+    The watchers of one key run for one value after another, but those
+    of different keys run in parallel, so a slow watcher (like one
+    running xdotool) only delays its own key.  `policies` maps keys to
+    what to do with values which arrive while the key's watchers are
+    still running:
+
+    - 'queue' (the default): run the watchers for every value, in order
+    - 'latest': run them only for the latest value, skipping those
+      which were superseded meanwhile
+
+    Watchers taking more than `slow` seconds are logged as warnings,
+    and `stats` has the runs, total and maximum time, and maximum delay
+    from the event to the start of each watcher.
+    """
+    POLICIES = {'queue', 'latest'}
+    _LOG = logging.getLogger('ObsState')
+
+    def __init__(self, threads=4, slow=1.0, policies=None):
+        self.slow = slow
+        self.policies = dict(policies or { })
+        unknown = set(self.policies.values()) - self.POLICIES
+        if unknown:
+            raise ValueError(f'Unknown watcher policies: {unknown!r}')
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix='ObsState watcher')
+        self._lock = threading.Lock()
+        self._queues = { }   # key -> deque of (funcs, value, time), while the key's watchers run
+        self.stats = collections.defaultdict(lambda: {'runs': 0, 'total': 0.0, 'max': 0.0, 'max_delay': 0.0})
+
+    def dispatch(self, key, funcs, value):
+        """Run funcs(value) after the earlier values of this key"""
+        funcs = list(funcs)
+        if not funcs:
+            return
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = collections.deque()
+                self._executor.submit(self._run, key)
+            elif self.policies.get(key) == 'latest':
+                queue.clear()
+            queue.append((funcs, value, time.perf_counter()))
+
+    def _run(self, key):
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                funcs, value, queued = queue.popleft()
+            for func in funcs:
+                start = time.perf_counter()
+                try:
+                    func(value)
+                except Exception:  # pylint: disable=broad-except
+                    self._LOG.exception('watcher %s of %r failed', func, key)
+                end = time.perf_counter()
+                if end - start > self.slow:
+                    self._LOG.warning('slow watcher %s of %r: %.1f s', func, key, end - start)
+                with self._lock:
+                    stats = self.stats[getattr(func, '__qualname__', repr(func))]
+                    stats['runs'] += 1
+                    stats['total'] += end - start
+                    stats['max'] = max(stats['max'], end - start)
+                    stats['max_delay'] = max(stats['max_delay'], start - queued)
+
 
 
 class ObsState:
@@ -24,15 +126,50 @@ class ObsState:
     The combination of OBS persistent state and OBS custom events allows
     clients to get updates as soon as a value is changed, but also sync
     to the last-set value each time the program starts.
+
+    Values which have been read or watched are cached, and kept up to
+    date by our own writes and by custom events, so reading them again
+    needs no request to OBS.  The cache is only as fresh as the event
+    connection: obsws_python doesn't reconnect, so after losing the
+    connection to OBS the program must be restarted (with an empty
+    cache) anyway.
+
+    Between _defer_watch_init() and _run_watch_init(), _watch_init()
+    callbacks aren't run at once: _run_watch_init() reads all their
+    values in one request and then runs them, so that starting a panel
+    with many widgets doesn't take one round-trip per widget.
+
+    Setting an attribute doesn't wait for OBS: the value is cached and
+    then saved and broadcast by a writer thread, in one RequestBatch
+    with the other values set meanwhile.  When the same key is set
+    again before that, only the latest value is sent, so dragging a
+    slider doesn't queue up every position.  _flush() waits until the
+    values set so far have been sent, for when something must happen
+    only after that; broadcast() and the property setters do it.
+
+    Watchers of events run on the threads of a WatcherDispatcher, not
+    on obsws_python's event thread; watcher_threads, slow_watcher and
+    watcher_policies are its arguments.
     """
     ATTRS = {
         ''
         }
     _LOG = logging.getLogger('ObsState')
-    def __init__(self, obsreq, obsev, config, test=False):
+    _batch_ids = itertools.count()
+    def __init__(self, obsreq, obsev, config, test=False,
+                 watcher_threads=4, slow_watcher=1.0, watcher_policies=None):
+        if not isinstance(obsreq, LockedClient):
+            obsreq = LockedClient(obsreq)
         super().__setattr__('_req', obsreq)
         super().__setattr__('_ev', obsev)
         super().__setattr__('_watchers', collections.defaultdict(set))
+        super().__setattr__('_cache', { })   # name -> value
+        super().__setattr__('_deferred_init', None)   # [(name, func)] while deferred
+        super().__setattr__('_writes', { })   # name -> value, not yet sent
+        super().__setattr__('_writes_cond', threading.Condition())
+        super().__setattr__('_writing', False)   # a batch of writes is in flight
+        super().__setattr__('_writer', None)
+        super().__setattr__('_dispatcher', WatcherDispatcher(watcher_threads, slow_watcher, watcher_policies))
         super().__setattr__('config', config)
         super().__setattr__('test', test)
         # Record what are class attributes and not auto-sent
@@ -48,27 +185,107 @@ class ObsState:
     def __getattr__(self, name):
         if name.startswith('_'):
             raise AttributeError(f'Invalid attribute {name!r}')
-        data = self._req.get_persistent_data('OBS_WEBSOCKET_DATA_REALM_PROFILE', name)
-        value = getattr(data, 'slot_value', None)
-        self._LOG.debug('obs.getattr {name!r}={value!r}')
+        if name in self._cache:
+            return self._cache[name]
+        value = self._get(name)
+        self._cache[name] = value
         return value
     __getitem__ = __getattr__
 
+    def _get(self, name):
+        """Read a value from OBS, without the cache"""
+        data = self._req.get_persistent_data(REALM, name)
+        value = getattr(data, 'slot_value', None)
+        self._LOG.debug('obs.getattr %r=%r', name, value)
+        return value
+
+    def _get_many(self, names):
+        """Read several values from OBS in one RequestBatch, without the cache"""
+        if self.test or len(names) < 2:
+            return {name: self._get(name) for name in names}
+        results = self._send_batch([{'requestType': 'GetPersistentData',
+                                     'requestData': {'realm': REALM, 'slotName': name}}
+                                    for name in names])
+        values = { }
+        for name, result in zip(names, results):
+            if not result['requestStatus']['result']:
+                raise RuntimeError(f'GetPersistentData {name!r} failed: {result["requestStatus"]}')
+            values[name] = result.get('responseData', { }).get('slotValue')
+        self._LOG.debug('obs._get_many %r', values)
+        return values
+
+    def _send_batch(self, requests):
+        """Send a RequestBatch on the ReqClient's connection and return its results.
+
+        obsws_python has no batch requests, so this uses its websocket
+        directly, like its own requests do.
+        """
+        client = self._req.base_client
+        request_id = f'obsstate-batch-{next(self._batch_ids)}'
+        with self._req.lock:
+            client.ws.send(json.dumps({'op': 8, 'd': {'requestId': request_id, 'requests': requests}}))
+            while True:
+                data = json.loads(client.ws.recv())
+                if data['op'] == 9 and data['d']['requestId'] == request_id:
+                    return data['d']['results']
+
     def __setattr__(self, name, value):
         if name in self._dir:
             super().__setattr__(name, value)
         if name.startswith('_'):
             raise AttributeError(f'Invalid attribute {name!r}')
         self._LOG.debug('obs.setattr %r=%r', name, value)
-        self._req.set_persistent_data('OBS_WEBSOCKET_DATA_REALM_PROFILE', name, value)
-        self._req.broadcast_custom_event({'eventData': {name: value}})
+        self._cache[name] = value
         if self.test:
+            self._req.set_persistent_data(REALM, name, value)
+            self._req.broadcast_custom_event({'eventData': {name: value}})
             self.on_custom_event(type('dummy', (), {name: value, 'attrs': lambda: [name]}))
+            return
+        with self._writes_cond:
+            # Move it to the end: the batch is in the order of the latest writes.
+            self._writes.pop(name, None)
+            self._writes[name] = value
+            self._writes_cond.notify_all()
+            if self._writer is None:
+                super().__setattr__('_writer', threading.Thread(target=self._write_loop,
+                                                                name='ObsState writer', daemon=True))
+                self._writer.start()
+                atexit.register(self._flush, timeout=5)
     __setitem__ = __setattr__
 
+    def _write_loop(self):
+        """Send the queued writes, those queued while a batch is in flight in the next batch"""
+        while True:
+            with self._writes_cond:
+                self._writes_cond.wait_for(lambda: self._writes)
+                writes = dict(self._writes)
+                self._writes.clear()
+                super().__setattr__('_writing', True)
+            try:
+                requests = [{'requestType': 'SetPersistentData',
+                             'requestData': {'realm': REALM, 'slotName': name, 'slotValue': value}}
+                            for name, value in writes.items()]
+                requests.append({'requestType': 'BroadcastCustomEvent',
+                                 'requestData': {'eventData': writes}})
+                for request, result in zip(requests, self._send_batch(requests)):
+                    if not result['requestStatus']['result']:
+                        self._LOG.error('obs write failed: %r: %r', request, result['requestStatus'])
+            except Exception:  # pylint: disable=broad-except
+                self._LOG.exception('obs write of %r failed', list(writes))
+            finally:
+                with self._writes_cond:
+                    super().__setattr__('_writing', False)
+                    self._writes_cond.notify_all()
+
+    def _flush(self, timeout=None):
+        """Wait until the values set so far are sent.  Return False on timeout."""
+        with self._writes_cond:
+            return self._writes_cond.wait_for(lambda: not self._writes and not self._writing, timeout)
+
     def broadcast(self, name, value):
         """Like __setattr__, but only broadcasts, doesn't save persistent data"""
         self._LOG.debug('obs.broadcast %r=%r', name, value)
+        self._flush()
         self._req.broadcast_custom_event({'eventData': {name: value}})
         if self.test:
             self.on_custom_event(type('dummy', (), {name: value, 'attrs': lambda: [name]}))
@@ -77,20 +294,23 @@ class ObsState:
         self._LOG.debug('obs.hasattr %r', name)
         if name.startswith('_'):
             raise AttributeError(f'Invalid attribute {name!r}')
-        data = self._req.get_persistent_data('OBS_WEBSOCKET_DATA_REALM_PROFILE', name)
-        value = getattr(data, 'slot_value', None)
-        if value is None:
-            return False
-        return True
+        return getattr(self, name) is not None
+
+    def on_exit_started(self, event):
+        """OBS is exiting: the cache won't be kept up to date"""
+        self._cache.clear()
 
     def on_custom_event(self, event):
         """Watcher for custom events"""
         self._LOG.debug('custom event %r (%r)', event, event.attrs())
         for attr in event.attrs():
+            # Broadcasts of values which aren't saved (broadcast()) are
+            # cached too, if the value was read or watched.
+            if attr in self._cache or attr in self._watchers:
+                self._cache[attr] = getattr(event, attr)
             if attr in self._watchers:
-                for func in self._watchers[attr]:
-                    self._LOG.debug('custom event attr=%r func=%s', attr, func)
-                    func(getattr(event, attr))
+                self._LOG.debug('custom event attr=%r funcs=%s', attr, self._watchers[attr])
+                self._dispatcher.dispatch(attr, self._watchers[attr], getattr(event, attr))
 
     def _watch(self, name, func):
         """Set a watcher for updates of this key"""
@@ -101,8 +321,29 @@ class ObsState:
         """Set a watcher for this key.  Also run the callback once with the current value."""
         self._LOG.debug('obs._watch_init add %r=%s', name, func)
         self._watchers[name].add(func)
+        if self._deferred_init is not None:
+            self._deferred_init.append((name, func))
+            return
         func(getattr(self, name))
 
+    def _defer_watch_init(self):
+        """Don't run _watch_init() callbacks until _run_watch_init()"""
+        if self._deferred_init is None:
+            super().__setattr__('_deferred_init', [ ])
+
+    def _run_watch_init(self):
+        """Read the values of deferred _watch_init() calls at once, and run their callbacks"""
+        deferred = self._deferred_init or [ ]
+        super().__setattr__('_deferred_init', None)
+        names = list(dict.fromkeys(name for name, _ in deferred))
+        # Properties (like scene) aren't persistent data, read them once each.
+        values = {name: getattr(self, name) for name in names if name in self._dir}
+        missing = [name for name in names if name not in values and name not in self._cache]
+        self._LOG.debug('obs._run_watch_init %d callbacks, reading %r', len(deferred), missing)
+        self._cache.update(self._get_many(missing))
+        for name, func in deferred:
+            func(values[name] if name in values else getattr(self, name))
+
     # Custom properties
     @property
     def scene(self):
@@ -112,19 +353,20 @@ class ObsState:
     @scene.setter
     def scene(self, value):
         self._LOG.debug('obs.scene set scene=%r', value)
+        self._flush()
         self._req.set_current_program_scene(value)
         if self.test:
             self.on_current_program_scene_changed(type('dummy', (), {'scene_name': value}))
     def on_current_program_scene_changed(self, data):
-        for func in self._watchers['scene']:
-            self._LOG.debug('obs.scene watch scene %r', func)
-            func(data.scene_name)
+        self._LOG.debug('obs.scene watch scene %r', self._watchers['scene'])
+        self._dispatcher.dispatch('scene', self._watchers['scene'], data.scene_name)
 
     @property
     def muted(self):
         return self._req.get_input_mute(self.config['AUDIO_INPUT']).input_muted
     @muted.setter
     def muted(self, value):
+        self._flush()
         self._req.set_input_mute(self.config['AUDIO_INPUT'], value)
         if self.test:
             self.on_input_mute_state_changed(type('dummy', (), {'input_muted': value}))
@@ -133,6 +375,7 @@ class ObsState:
         return self._req.get_input_mute(self.config['AUDIO_INPUT']).input_muted
     @muted_brcd.setter
     def muted_brcd(self, value):
+        self._flush()
         self._req.set_input_mute(self.config['AUDIO_INPUT'], value)
         if self.test:
             self.on_input_mute_state_changed(type('dummy', (), {'input_muted': value}))
@@ -143,5 +386,4 @@ class ObsState:
             (self.config['AUDIO_INPUT_BRCD'], 'muted_brcd'),
             ]:
             if data.input_name == ctrl:
-                for func in self._watchers[name]:
-                    func(data.input_muted)
+                self._dispatcher.dispatch(name, self._watchers[name], data.input_muted)
@@ -0,0 +1,204 @@
+"""Micro-benchmark of websocket_proxy message handling.
+
+Measures messages/second of the proxy's per-message work, without any
+network, comparing the current code ("after") with the way it used to
+be done ("before"): parse every message with json.loads and serialize
+it again.
+
+    python -m obs_cr.proxy_benchmark [--screenshot-kb=1000] [--seconds=1]
+
+Forward is client->OBS (request filtering and requestId rewriting),
+return is OBS->client (requestId rewriting and event fan-out).
+
+Also prints the bytes a client receives for the same traffic with each
+subprotocol and permessage-deflate level.
+"""
+
+import argparse
+import base64
+import itertools
+import json
+import random
+import time
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from . import websocket_proxy
+from .websocket_proxy import Client, Pending, Upstream, check_request, filter_forwarded, peek
+
+
+REALM = 'OBS_WEBSOCKET_DATA_REALM_PROFILE'
+
+
+def client_messages():
+    """Typical panel requests, as obs-websocket-js sends them"""
+    requests = [
+        ('GetPersistentData', {'realm': REALM, 'slotName': 'preset-a-label'}),
+        ('SetPersistentData', {'realm': REALM, 'slotName': 'indicator-time', 'slotValue': True}),
+        ('BroadcastCustomEvent', {'eventData': {'indicator-time': True}}),
+        ('GetSourceScreenshot', {'sourceName': 'Notes', 'imageFormat': 'jpg', 'imageWidth': 420}),
+        ('SetSceneItemTransform', {'sceneName': 'Notes', 'sceneItemId': 7,
+                                   'sceneItemTransform': {'scaleX': 0.25, 'scaleY': 0.25}}),
+        ('GetCurrentProgramScene', {}),
+        ('SetInputSettings', {'inputName': 'Announcement', 'inputSettings': {'text': 'Break until xx:10'}}),
+        ]
+    return [json.dumps({'op': 6, 'd': {'requestType': t, 'requestId': str(i), 'requestData': d}},
+                       separators=(',', ':'))
+            for i, (t, d) in enumerate(requests)]
+
+
+def obs_messages(screenshot_kb):
+    """Typical OBS messages (keys sorted, like OBS sends them)"""
+    def response(request_type, data):
+        return json.dumps({'op': 7, 'd': {'requestType': request_type, 'requestId': 'X',
+                                          'requestStatus': {'result': True, 'code': 100},
+                                          'responseData': data}},
+                          separators=(',', ':'), sort_keys=True)
+    def event(event_type, intent, data):
+        return json.dumps({'op': 5, 'd': {'eventType': event_type, 'eventIntent': intent,
+                                          'eventData': data}},
+                          separators=(',', ':'), sort_keys=True)
+    # JPEG data is about as compressible as random bytes.
+    image = 'data:image/jpg;base64,' + base64.b64encode(
+        random.Random(0).randbytes(screenshot_kb * 750)).decode()
+    return [
+        response('GetPersistentData', {'slotValue': 'Gallery'}),
+        response('SetPersistentData', {}),
+        response('GetSourceScreenshot', {'imageData': image}),
+        event('CustomEvent', 1, {'indicator-time': True}),
+        event('CurrentProgramSceneChanged', 4, {'sceneName': 'Notes'}),
+        ]
+
+
+#
+# Before: every message parsed and serialized again.
+#
+def forward_before(message, request_id):
+    data = json.loads(message)
+    if data['op'] == 6:
+        if check_request(data['d']) is not None:
+            return None
+        message = json.dumps(data)
+    data = json.loads(message)
+    data['d']['requestId'] = request_id
+    return json.dumps(data)
+
+def return_before(message, pending, clients):
+    data = json.loads(message)
+    if data['op'] == 7:
+        client, request_id = pending[data['d']['requestId']]
+        data['d']['requestId'] = request_id
+        client.send(json.dumps(data))
+    elif data['op'] == 5:
+        for client in clients:
+            client.send(message)
+
+
+#
+# After: the current code.
+#
+def forward_after(upstream, client, message):
+    op = peek(message, 'op')
+    requestType = peek(message, 'd', 'requestType')
+    message = filter_forwarded(message, None, op, requestType)
+    if message is not None:
+        return upstream.prepare(client, message, op, requestType)
+
+def return_after(upstream, client, message):
+    upstream.pending['X'] = Pending(client, '1', None, None, None, 0)
+    upstream.route(message)
+
+
+def rate(func, messages, seconds):
+    """Messages/second of calling func(message) for all messages, repeated for about `seconds`"""
+    n = 0
+    start = time.perf_counter()
+    for message in itertools.cycle(messages):
+        func(message)
+        n += 1
+        if n % len(messages) == 0 and time.perf_counter() - start > seconds:
+            break
+    return n / (time.perf_counter() - start)
+
+
+def deflated_size(frames, level):
+    """Bytes of `frames` sent in order with permessage-deflate, as websockets does it"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -12, 5)
+    size = 0
+    for frame in frames:
+        data = compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        size += len(data) - 4    # the 00 00 ff ff tail isn't sent
+    return size
+
+def bandwidth(messages):
+    """Print the bytes sent for `messages` (JSON) by subprotocol and deflate level"""
+    frames = {'json': [m.encode() for m in messages]}
+    if msgpack is not None:
+        frames['msgpack'] = [msgpack.packb(json.loads(m)) for m in messages]
+    sizes = { }
+    for protocol in frames:
+        sizes[protocol] = sum(len(f) for f in frames[protocol])
+        for level in (1, 6, 9):
+            sizes[f'{protocol}, deflate level {level}'] = deflated_size(frames[protocol], level)
+    for name, size in sizes.items():
+        print(f"{'  ' + name:40} {size:12} {size/sizes['json']:8.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--screenshot-kb', type=int, default=1000,
+                        help="Size of screenshot responses, default=%(default)s")
+    parser.add_argument('--clients', type=int, default=10,
+                        help="Number of clients events are fanned out to, default=%(default)s")
+    parser.add_argument('--seconds', type=float, default=1, help="Time per measurement, default=%(default)s")
+    args = parser.parse_args()
+    websocket_proxy.args = argparse.Namespace(verbose=0)
+
+    upstream = Upstream('ws://localhost:4455')
+    clients = [Client(None) for _ in range(args.clients)]
+    for client in clients:
+        upstream.clients.add(client)
+    client = clients[0]
+    def drain():
+        for c in clients:
+            c.queue.clear()
+            c.queued_bytes = 0
+            c._latest.clear()
+
+    forward = client_messages()
+    returned = obs_messages(args.screenshot_kb)
+    pending = {'X': (client, '1')}
+
+    print(f"{'':40} {'before':>12} {'after':>12} {'speedup':>8}  (messages/s)")
+    def report(name, before, after):
+        print(f'{name:40} {before:12.0f} {after:12.0f} {after/before:7.1f}x')
+
+    report('forward (mixed requests)',
+           rate(lambda m: forward_before(m, '1'), forward, args.seconds),
+           rate(lambda m: forward_after(upstream, client, m), forward, args.seconds))
+    upstream.pending.clear()
+    for message in returned:
+        d = json.loads(message)['d']
+        name = f"return {d.get('requestType') or d['eventType']}"
+        if len(message) > 10**5:
+            name = f'{name} ({len(message)//1000} kB)'
+        before = rate(lambda m: (return_before(m, pending, clients), drain()), [message], args.seconds)
+        after = rate(lambda m: (return_after(upstream, client, m), drain()), [message], args.seconds)
+        report(name, before, after)
+
+    print()
+    print(f"{'bytes sent to a client':40} {'bytes':>12} {'of json':>8}")
+    screenshot = [m for m in returned if len(m) > 10**5]
+    small = [m for m in returned if len(m) <= 10**5]
+    print('screenshot responses')
+    bandwidth(screenshot)
+    print('other responses and events, 100 times')
+    bandwidth(small * 100)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+"""Load test of websocket_proxy with a fake OBS and simulated panels.
+
+Everything runs on localhost: a fake obs-websocket v5 server in this
+process, the proxy as a subprocess, and N simulated panel clients.
+Prints request throughput, latency percentiles by request type, and the
+proxy's CPU time and memory.
+
+    python -m obs_cr.proxy_loadtest [--clients=20] [--seconds=10] [-- PROXY OPTIONS]
+    python -m obs_cr.proxy_loadtest --clients=50 -- --multiplex --workers=2
+
+Clients behave like the pages: each connects and runs the watch-init
+storm (one GetPersistentData per watched name, one after another, like
+obs_watch_init), all clients at once unless --ramp is given.  Then
+--preview-clients poll screenshots like preview pages, --slider-clients
+drag sliders (SetInputVolume, and SetPersistentData plus
+BroadcastCustomEvent like obs_set), and the rest only receive events.
+
+--direct connects the clients to the fake OBS without the proxy, for
+comparison.  The clients and the fake OBS share one process, so on a
+small machine they compete with the proxy for CPU: the harness's own
+CPU time is printed too.
+"""
+
+import argparse
+import asyncio
+import base64
+import collections
+import itertools
+import json
+import os
+import random
+import resource
+import socket
+import sys
+import time
+
+import websockets
+
+from .obsauth import check_auth, obs_auth
+
+
+PASSWORD = 'loadtest'
+REALM = 'OBS_WEBSOCKET_DATA_REALM_PROFILE'
+SCENES = ['Notes', 'Gallery', 'Screenshare', 'Break']
+INPUTS = ['Instructors', 'BroadcasterMic']
+
+
+class FakeOBS:
+    """Minimal obs-websocket v5 server.
+
+    Requests of one session are answered in order, each after `latency`
+    seconds (`screenshot_latency` for GetSourceScreenshot), which is
+    roughly how OBS handles them.  Persistent data, volumes, and the
+    program scene are kept, and the usual events sent for changes.
+    """
+
+    def __init__(self, latency=0.001, screenshot_latency=0.02, screenshot_kb=100):
+        self.latency = latency
+        self.screenshot_latency = screenshot_latency
+        # JPEG data is about as compressible as random bytes.
+        self.image = 'data:image/jpg;base64,' + base64.b64encode(
+            random.Random(0).randbytes(screenshot_kb * 750)).decode()
+        self.state = { }
+        self.volumes = {name: -10.0 for name in INPUTS}
+        self.scene = SCENES[0]
+        self.sessions = set()
+        self.requests = 0
+        self.service = collections.defaultdict(list)   # requestType -> [seconds from receiving to answering]
+
+    def broadcast(self, event_type, intent, data):
+        message = json.dumps({'op': 5, 'd': {'eventType': event_type, 'eventIntent': intent,
+                                             'eventData': data}})
+        for ws in list(self.sessions):
+            asyncio.create_task(ws.send(message))
+
+    async def answer(self, request):
+        """The `d` of the response to the `d` of a request"""
+        self.requests += 1
+        request_type = request['requestType']
+        data = request.get('requestData') or { }
+        await asyncio.sleep(self.screenshot_latency if request_type == 'GetSourceScreenshot' else self.latency)
+        response_data = { }
+        if request_type == 'GetPersistentData':
+            response_data = {'slotValue': self.state.get(data['slotName'])}
+        elif request_type == 'SetPersistentData':
+            self.state[data['slotName']] = data.get('slotValue')
+        elif request_type == 'BroadcastCustomEvent':
+            self.broadcast('CustomEvent', 1 << 9, data.get('eventData', { }))
+        elif request_type == 'GetSourceScreenshot':
+            response_data = {'imageData': self.image}
+        elif request_type == 'SetInputVolume':
+            self.volumes[data['inputName']] = data.get('inputVolumeDb', 0)
+            self.broadcast('InputVolumeChanged', 1 << 3, {'inputName': data['inputName'],
+                           'inputVolumeDb': self.volumes[data['inputName']],
+                           'inputVolumeMul': 10 ** (self.volumes[data['inputName']] / 20)})
+        elif request_type == 'GetInputVolume':
+            response_data = {'inputVolumeDb': self.volumes.get(data.get('inputName'), 0)}
+        elif request_type == 'GetCurrentProgramScene':
+            response_data = {'currentProgramSceneName': self.scene, 'sceneName': self.scene}
+        elif request_type == 'SetCurrentProgramScene':
+            self.scene = data['sceneName']
+            self.broadcast('CurrentProgramSceneChanged', 1 << 2, {'sceneName': self.scene})
+        elif request_type == 'GetSceneList':
+            response_data = {'currentProgramSceneName': self.scene, 'currentPreviewSceneName': None,
+                             'scenes': [{'sceneIndex': i, 'sceneName': name}
+                                        for i, name in enumerate(reversed(SCENES))]}
+        elif request_type == 'GetSceneItemList':
+            response_data = {'sceneItems': [{'sceneItemId': 1, 'sceneItemIndex': 0, 'sourceName': 'Gallery',
+                                             'sceneItemEnabled': True}]}
+        elif request_type == 'GetSceneItemId':
+            response_data = {'sceneItemId': 1}
+        elif request_type == 'GetVersion':
+            response_data = {'obsVersion': '30.0.0', 'obsWebSocketVersion': '5.3.0', 'rpcVersion': 1}
+        response = {'requestType': request_type, 'requestStatus': {'result': True, 'code': 100}}
+        if 'requestId' in request:
+            response['requestId'] = request['requestId']
+        if response_data:
+            response['responseData'] = response_data
+        return response
+
+    async def handle(self, ws):
+        challenge, salt = 'challenge', 'salt'
+        await ws.send(json.dumps({'op': 0, 'd': {
+            'obsWebSocketVersion': '5.3.0', 'rpcVersion': 1,
+            'authentication': {'challenge': challenge, 'salt': salt}}}))
+        identify = json.loads(await ws.recv())['d']
+        if not check_auth(identify.get('authentication'), PASSWORD, salt, challenge):
+            await ws.close(4009, 'Authentication failed')
+            return
+        await ws.send(json.dumps({'op': 2, 'd': {'negotiatedRpcVersion': 1}}))
+        self.sessions.add(ws)
+        try:
+            async for message in ws:
+                start = time.perf_counter()
+                data = json.loads(message)
+                if data['op'] == 6:
+                    await ws.send(json.dumps({'op': 7, 'd': await self.answer(data['d'])}))
+                    self.service[data['d']['requestType']].append(time.perf_counter() - start)
+                elif data['op'] == 8:
+                    results = [await self.answer(request) for request in data['d']['requests']]
+                    await ws.send(json.dumps({'op': 9, 'd': {'requestId': data['d']['requestId'],
+                                                             'results': results}}))
+                    self.service['RequestBatch'].append(time.perf_counter() - start)
+                elif data['op'] == 3:
+                    await ws.send(json.dumps({'op': 2, 'd': {'negotiatedRpcVersion': 1}}))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.sessions.discard(ws)
+
+
+class Stats:
+    def __init__(self):
+        self.latency = collections.defaultdict(list)   # requestType -> [seconds]
+        self.failed = collections.Counter()   # requestType -> number
+        self.events = 0
+
+
+class SimClient:
+    """One simulated panel"""
+
+    def __init__(self, url, stats):
+        self.url = url
+        self.stats = stats
+        self.pending = { }   # requestId -> future
+        self._ids = itertools.count()
+
+    async def connect(self):
+        self.ws = await websockets.connect(self.url, subprotocols=['obswebsocket.json'], max_size=None)
+        hello = json.loads(await self.ws.recv())['d']
+        identify = {'rpcVersion': 1, 'eventSubscriptions': 0x3ff}
+        if 'authentication' in hello:
+            identify['authentication'] = obs_auth(PASSWORD, hello['authentication']['salt'],
+                                                  hello['authentication']['challenge'])
+        await self.ws.send(json.dumps({'op': 1, 'd': identify}))
+        json.loads(await self.ws.recv())
+        asyncio.create_task(self.read())
+
+    async def read(self):
+        try:
+            async for message in self.ws:
+                data = json.loads(message)
+                if data['op'] == 5:
+                    self.stats.events += 1
+                elif data['op'] == 7:
+                    future = self.pending.pop(data['d'].get('requestId'), None)
+                    if future is not None and not future.done():
+                        future.set_result(data['d'])
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def call(self, request_type, request_data=None):
+        request_id = str(next(self._ids))
+        future = self.pending[request_id] = asyncio.get_running_loop().create_future()
+        start = time.perf_counter()
+        await self.ws.send(json.dumps({'op': 6, 'd': {'requestType': request_type, 'requestId': request_id,
+                                                      'requestData': request_data or { }}}))
+        response = await future
+        self.stats.latency[request_type].append(time.perf_counter() - start)
+        if not response['requestStatus']['result']:
+            self.stats.failed[request_type] += 1
+        return response
+
+    async def watch_init(self, names):
+        start = time.perf_counter()
+        for name in names:
+            await self.call('GetPersistentData', {'realm': REALM, 'slotName': name})
+        await self.call('GetCurrentProgramScene')
+        for name in INPUTS:
+            await self.call('GetInputVolume', {'inputName': name})
+        self.stats.latency['(watch-init storm)'].append(time.perf_counter() - start)
+
+    async def preview(self, interval):
+        while True:
+            await self.call('GetSourceScreenshot', {'sourceName': random.choice(SCENES), 'imageFormat': 'jpg',
+                                                    'imageWidth': 420})
+            await asyncio.sleep(interval)
+
+    async def slider(self, rng):
+        while True:
+            # One drag: a volume slider at 30 steps/s, then a synced setting like obs_set.
+            name = rng.choice(INPUTS)
+            for step in range(30):
+                await self.call('SetInputVolume', {'inputName': name, 'inputVolumeDb': -30 + step})
+                await asyncio.sleep(1/30)
+            value = rng.randrange(100)
+            await self.call('SetPersistentData', {'realm': REALM, 'slotName': 'gallerysize', 'slotValue': value})
+            await self.call('BroadcastCustomEvent', {'eventData': {'gallerysize': value}})
+            await asyncio.sleep(rng.uniform(0.5, 2))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def process_usage(pid):
+    """(CPU seconds, RSS bytes, peak RSS bytes) of pid and its children, from /proc"""
+    pids = [pid]
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        pids.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    cpu = rss = peak = 0
+    for p in pids:
+        try:
+            with open(f'/proc/{p}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')   # utime, stime
+            with open(f'/proc/{p}/status') as f:
+                status = dict(line.split(':', 1) for line in f)
+            rss += int(status['VmRSS'].split()[0]) * 1024
+            peak += int(status['VmHWM'].split()[0]) * 1024
+        except (OSError, KeyError):
+            pass
+    return cpu, rss, peak
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def start_proxy(port, obs_port, proxy_args):
+    proxy = await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'obs_cr.websocket_proxy', f'127.0.0.1:{port}',
+        '--obs', f'ws://127.0.0.1:{obs_port}', '--password', PASSWORD, *proxy_args,
+        stdout=asyncio.subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return proxy
+        except OSError:
+            await asyncio.sleep(0.1)
+    proxy.kill()
+    raise RuntimeError('The proxy did not start')
+
+
+async def run(args):
+    obs = FakeOBS(args.obs_latency / 1000, args.screenshot_latency / 1000, args.screenshot_kb)
+    server = await websockets.serve(obs.handle, '127.0.0.1', 0, subprotocols=['obswebsocket.json'],
+                                    max_size=None)
+    obs_port = server.sockets[0].getsockname()[1]
+    proxy = None
+    if args.direct:
+        url = f'ws://127.0.0.1:{obs_port}'
+    else:
+        port = free_port()
+        proxy = await start_proxy(port, obs_port, args.proxy_args)
+        url = f'ws://127.0.0.1:{port}'
+    stats = Stats()
+    names = [f'loadtest-{i}' for i in range(args.watched)]
+    rng = random.Random(0)
+    tasks = [ ]
+    usage = process_usage(proxy.pid) if proxy else None
+    harness_cpu = sum(resource.getrusage(resource.RUSAGE_SELF)[:2])
+    start = time.perf_counter()
+
+    async def client(i):
+        if args.ramp:
+            await asyncio.sleep(args.ramp * i / args.clients)
+        c = SimClient(url, stats)
+        await c.connect()
+        await c.watch_init(names)
+        if i < args.preview_clients:
+            await c.preview(args.preview_interval)
+        elif i < args.preview_clients + args.slider_clients:
+            await c.slider(random.Random(rng.random()))
+        else:
+            await asyncio.Future()
+    try:
+        tasks = [asyncio.create_task(client(i)) for i in range(args.clients)]
+        done, _ = await asyncio.wait(tasks, timeout=args.seconds, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()   # raise errors of clients
+        elapsed = time.perf_counter() - start
+        if proxy:
+            end_usage = process_usage(proxy.pid)
+        harness_cpu = sum(resource.getrusage(resource.RUSAGE_SELF)[:2]) - harness_cpu
+    finally:
+        for task in tasks:
+            task.cancel()
+        if proxy:
+            proxy.terminate()
+            await proxy.wait()
+        server.close()
+
+    idle = args.clients - args.preview_clients - args.slider_clients
+    print(f'{args.clients} clients ({args.preview_clients} preview, {args.slider_clients} slider, '
+          f'{max(idle, 0)} idle) for {elapsed:.1f} s, '
+          + ('direct to OBS' if args.direct else f"proxy options: {' '.join(args.proxy_args) or '(none)'}"))
+    print(f"{'request':28} {'count':>8} {'per s':>8} {'p50 ms':>8} {'p99 ms':>8} {'failed':>7}")
+    total = 0
+    for request_type, latencies in sorted(stats.latency.items()):
+        if not request_type.startswith('('):
+            total += len(latencies)
+        print(f'{request_type:28} {len(latencies):8} {len(latencies)/elapsed:8.1f} '
+              f'{percentile(latencies, 0.5)*1000:8.1f} {percentile(latencies, 0.99)*1000:8.1f} '
+              f'{stats.failed[request_type]:7}')
+    print(f"{'total':28} {total:8} {total/elapsed:8.1f}")
+    print(f'events received by clients: {stats.events} ({stats.events/elapsed:.0f}/s), '
+          f'requests to OBS: {obs.requests}')
+    if proxy:
+        cpu = end_usage[0] - usage[0]
+        print(f'proxy CPU {cpu:.2f} s ({cpu/elapsed:.0%} of a core), '
+              f'RSS {end_usage[1]/2**20:.1f} MB (peak {end_usage[2]/2**20:.1f} MB)')
+    print(f'harness (fake OBS and clients) CPU {harness_cpu:.2f} s ({harness_cpu/elapsed:.0%} of a core)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+                                     usage='%(prog)s [options] [-- PROXY OPTIONS]')
+    parser.add_argument('--clients', type=int, default=20, help="Number of clients, default=%(default)s")
+    parser.add_argument('--preview-clients', type=int, help="Clients polling screenshots, default=clients/4")
+    parser.add_argument('--slider-clients', type=int, help="Clients dragging sliders, default=clients/4")
+    parser.add_argument('--seconds', type=float, default=10, help="Length of the test, default=%(default)s")
+    parser.add_argument('--ramp', type=float, default=0, metavar='SECONDS',
+                        help="Spread the client connections over this time, default=%(default)s (all at once)")
+    parser.add_argument('--watched', type=int, default=40,
+                        help="Persistent data names read by each client on connect, default=%(default)s")
+    parser.add_argument('--preview-interval', type=float, default=0.5, metavar='SECONDS',
+                        help="Time between screenshots of a preview client, default=%(default)s")
+    parser.add_argument('--obs-latency', type=float, default=1, metavar='MS',
+                        help="Time the fake OBS takes per request, default=%(default)s")
+    parser.add_argument('--screenshot-latency', type=float, default=20, metavar='MS',
+                        help="Time the fake OBS takes per screenshot, default=%(default)s")
+    parser.add_argument('--screenshot-kb', type=int, default=100,
+                        help="Size of screenshot responses, default=%(default)s")
+    parser.add_argument('--direct', action='store_true', help="Connect clients to the fake OBS, without the proxy")
+    parser.add_argument('proxy_args', nargs='*', metavar='PROXY OPTIONS',
+                        help="Options for websocket_proxy, after --")
+    args = parser.parse_args()
+    if args.preview_clients is None:
+        args.preview_clients = args.clients // 4
+    if args.slider_clients is None:
+        args.slider_clients = args.clients // 4
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
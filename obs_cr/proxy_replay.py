@@ -0,0 +1,283 @@
+"""Replay traffic recorded with websocket_proxy --record.
+
+Replays the clients of a recording against the proxy in front of the
+fake OBS of proxy_loadtest, all on localhost, and compares request
+latencies with the recorded ones.
+
+    python -m obs_cr.proxy_replay LOG [--speed=1 | --fast] [-- PROXY OPTIONS]
+    python -m obs_cr.proxy_replay LOG --save=before.json -- --multiplex
+    python -m obs_cr.proxy_replay LOG --baseline=before.json -- --multiplex
+
+Clients connect at the recorded times (divided by --speed).  A message
+which the client sent when all its earlier requests were answered is
+sent once that is also the case in the replay, after the recorded
+pause; others follow the previous message after the recorded pause, so
+that a slower proxy doesn't make clients send in bursts they didn't
+send.  With --fast there are no pauses.  Latency is split into the time the fake
+OBS took and the rest (the proxy, and waiting for OBS), per request type
+and per --window of the recording, so that a slowdown can be pinned to
+requests and moments.  --save writes the results, and --baseline
+compares with a saved replay instead of the recording, e.g. to compare
+two versions of the proxy on the same day's traffic.
+
+The fake OBS answers everything generically, so the replay is
+deterministic, but responses aren't those of the real OBS.
+"""
+
+import argparse
+import asyncio
+import collections
+import gzip
+import json
+import time
+
+import websockets
+
+from .obsauth import obs_auth
+from .proxy_loadtest import FakeOBS, PASSWORD, free_port, percentile, process_usage, start_proxy
+
+
+def read_log(path):
+    """Clients of a --record log: (run, client id) -> {'path', 'events': [(seconds, direction, message)]}
+
+    Runs of the proxy which were appended to the same log are replayed
+    one after another: the seconds of each run start where the previous
+    run's end.
+    """
+    clients = collections.defaultdict(lambda: {'path': '/', 'events': [ ]})
+    run = 0
+    offset = end = 0   # seconds before this run, last seconds seen
+    with gzip.open(path, 'rt') as f:
+        try:
+            for line in f:
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    break   # the proxy was stopped while writing
+                if isinstance(data, dict):   # {"start"} of a run
+                    run += 1
+                    offset = end
+                    continue
+                t, client, direction, message = data
+                t += offset
+                end = max(end, t)
+                if direction == 'open':
+                    clients[run, client]['path'] = message
+                clients[run, client]['events'].append((t, direction, message))
+        except EOFError:
+            pass   # the proxy was stopped before closing the file
+    return clients
+
+
+def request_key(message):
+    """(requestId, requestType) of a request or response message, else None"""
+    data = json.loads(message)
+    if data['op'] in {6, 7}:
+        return data['d'].get('requestId'), data['d']['requestType']
+    if data['op'] in {8, 9}:
+        return data['d'].get('requestId'), 'RequestBatch'
+    return None
+
+
+def recorded_latencies(clients):
+    """[(time sent, requestType, seconds)] of the requests in the recording"""
+    latencies = [ ]
+    for client in clients.values():
+        sent = { }
+        for t, direction, message in client['events']:
+            key = request_key(message) if direction in {'>', '<'} else None
+            if key is None:
+                continue
+            if direction == '>':
+                sent[key[0]] = t
+            elif key[0] in sent:
+                start = sent.pop(key[0])
+                latencies.append((start, key[1], t - start))
+    return latencies
+
+
+class ReplayClient:
+    def __init__(self, url, client, results):
+        self.url = url + client['path']
+        self.events = client['events']
+        self.results = results   # [(recorded time sent, requestType, seconds)]
+        self.sent = { }   # requestId -> (recorded time, perf_counter when sent)
+        self.idle = asyncio.Event()   # set when all requests are answered
+
+    def schedule(self):
+        """[(recorded time, after all responses, recorded pause before, direction, message)] of the events"""
+        schedule = [ ]
+        outstanding = set()
+        last_sent = last_answered = 0
+        for t, direction, message in self.events:
+            key = request_key(message) if direction in {'>', '<'} else None
+            if direction == '<':
+                if key is not None and key[0] in outstanding:
+                    outstanding.discard(key[0])
+                    last_answered = t
+                continue
+            after_responses = not outstanding and last_answered > last_sent
+            schedule.append((t, after_responses, t - (last_answered if after_responses else last_sent),
+                             direction, message))
+            last_sent = t
+            if direction == '>' and key is not None:
+                outstanding.add(key[0])
+        return schedule
+
+    async def read(self):
+        try:
+            async for message in self.ws:
+                key = request_key(message)
+                if key is not None and key[0] in self.sent:
+                    recorded, start = self.sent.pop(key[0])
+                    self.results.append((recorded, key[1], time.perf_counter() - start))
+                    if not self.sent:
+                        self.idle.set()
+        except websockets.exceptions.ConnectionClosed:
+            self.idle.set()
+
+    async def run(self, start, speed):
+        """Replay, connecting at start + recorded time/speed (speed None: no pauses)"""
+        if speed is not None:
+            await asyncio.sleep(max(0, start + self.events[0][0]/speed - time.perf_counter()))
+        self.ws = None
+        reader = None
+        for t, after_responses, pause, direction, message in self.schedule():
+            if after_responses and self.sent:
+                await self.idle.wait()
+            if speed is not None:
+                await asyncio.sleep(pause / speed)
+            if direction == 'open':
+                self.ws = await websockets.connect(self.url, subprotocols=['obswebsocket.json'], max_size=None)
+                hello = json.loads(await self.ws.recv())['d']
+            elif direction == 'close':
+                break
+            elif direction == '>' and self.ws is not None:
+                data = json.loads(message)
+                if data['op'] == 1:
+                    if 'authentication' in hello:
+                        data['d']['authentication'] = obs_auth(PASSWORD, hello['authentication']['salt'],
+                                                               hello['authentication']['challenge'])
+                    await self.ws.send(json.dumps(data))
+                    json.loads(await self.ws.recv())   # Identified
+                    reader = asyncio.create_task(self.read())
+                    continue
+                key = request_key(message)
+                if key is not None:
+                    self.sent[key[0]] = (t, time.perf_counter())
+                    self.idle.clear()
+                await self.ws.send(message)
+        if self.ws is None:
+            return
+        if self.sent:
+            try:
+                await asyncio.wait_for(self.idle.wait(), 10)
+            except asyncio.TimeoutError:
+                print(f'{len(self.sent)} requests of {self.url} not answered')
+        await self.ws.close()
+        if reader is not None:
+            reader.cancel()
+
+
+def summarize(latencies, window):
+    """{'types': {requestType: [count, p50, p99]}, 'windows': {start: [count, p50, p99]}}"""
+    by_type = collections.defaultdict(list)
+    by_window = collections.defaultdict(list)
+    for t, request_type, seconds in latencies:
+        by_type[request_type].append(seconds)
+        by_window[t // window * window].append(seconds)
+    def stats(values):
+        return [len(values), percentile(values, 0.5), percentile(values, 0.99)]
+    return {'window': window, 'types': {k: stats(v) for k, v in by_type.items()},
+            'windows': {f'{k:g}': stats(v) for k, v in sorted(by_window.items())}}
+
+
+async def replay(args):
+    clients = read_log(args.log)
+    if not clients:
+        raise SystemExit(f'No clients in {args.log}')
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        args.window = baseline['window']   # windows must be the same to compare
+    obs = FakeOBS(args.obs_latency / 1000, args.screenshot_latency / 1000, args.screenshot_kb)
+    server = await websockets.serve(obs.handle, '127.0.0.1', 0, subprotocols=['obswebsocket.json'],
+                                    max_size=None)
+    port = free_port()
+    proxy = await start_proxy(port, server.sockets[0].getsockname()[1], args.proxy_args)
+    results = [ ]
+    try:
+        usage = process_usage(proxy.pid)
+        start = time.perf_counter()
+        await asyncio.gather(*(ReplayClient(f'ws://127.0.0.1:{port}', client, results)
+                               .run(start, None if args.fast else args.speed)
+                               for client in clients.values()))
+        elapsed = time.perf_counter() - start
+        end_usage = process_usage(proxy.pid)
+    finally:
+        proxy.terminate()
+        await proxy.wait()
+        server.close()
+
+    replayed = summarize(results, args.window)
+    replayed['obs'] = {k: [len(v), percentile(v, 0.5), percentile(v, 0.99)] for k, v in obs.service.items()}
+    if baseline is not None:
+        baseline_name = 'baseline'
+    else:
+        baseline, baseline_name = summarize(recorded_latencies(clients), args.window), 'recorded'
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(replayed, f, indent=1)
+
+    recorded_requests = sum(v[0] for v in summarize(recorded_latencies(clients), args.window)['types'].values())
+    print(f'{len(clients)} clients, {len(results)} requests ({recorded_requests} answered in the recording) '
+          f'in {elapsed:.1f} s, ' + ('--fast' if args.fast else f'--speed={args.speed}')
+          + f", proxy options: {' '.join(args.proxy_args) or '(none)'}")
+    print(f'proxy CPU {end_usage[0] - usage[0]:.2f} s, RSS {end_usage[1]/2**20:.1f} MB')
+    print()
+    print(f"{'':28} {baseline_name + ' ms':>17} {'replay ms':>17} {'OBS ms':>8} {'rest ms':>8}")
+    print(f"{'request':28} {'count':>5} {'p50':>5} {'p99':>5} {'count':>5} {'p50':>5} {'p99':>5} "
+          f"{'p50':>8} {'p50':>8}")
+    for request_type in sorted(set(baseline['types']) | set(replayed['types'])):
+        before = baseline['types'].get(request_type, [0, 0, 0])
+        after = replayed['types'].get(request_type, [0, 0, 0])
+        obs_p50 = replayed['obs'].get(request_type, [0, 0, 0])[1]
+        print(f'{request_type:28} {before[0]:5} {before[1]*1000:5.0f} {before[2]*1000:5.0f} '
+              f'{after[0]:5} {after[1]*1000:5.0f} {after[2]*1000:5.0f} '
+              f'{obs_p50*1000:8.1f} {max(0, after[1] - obs_p50)*1000:8.1f}')
+    print()
+    print(f'Windows of {args.window:g} s (recorded time) where p99 got most worse than {baseline_name}:')
+    changes = [(after[2] - baseline['windows'][w][2], w, baseline['windows'][w], after)
+               for w, after in replayed['windows'].items() if w in baseline['windows']]
+    for change, w, before, after in sorted(changes, reverse=True)[:args.top]:
+        print(f'  {float(w):8g} s: p99 {before[2]*1000:6.0f} ms -> {after[2]*1000:6.0f} ms '
+              f'({after[0]} requests)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+                                     usage='%(prog)s [options] LOG [-- PROXY OPTIONS]')
+    parser.add_argument('log', help="File written by websocket_proxy --record")
+    parser.add_argument('--speed', type=float, default=1, help="Replay speed factor, default=%(default)s")
+    parser.add_argument('--fast', action='store_true', help="Replay as fast as possible")
+    parser.add_argument('--window', type=float, default=10, metavar='SECONDS',
+                        help="Time windows to compare latency in, default=%(default)s")
+    parser.add_argument('--top', type=int, default=5, help="Windows to show, default=%(default)s")
+    parser.add_argument('--save', metavar='FILE', help="Save the results as JSON")
+    parser.add_argument('--baseline', metavar='FILE',
+                        help="Compare with results saved with --save (and use their --window)")
+    parser.add_argument('--obs-latency', type=float, default=1, metavar='MS',
+                        help="Time the fake OBS takes per request, default=%(default)s")
+    parser.add_argument('--screenshot-latency', type=float, default=20, metavar='MS',
+                        help="Time the fake OBS takes per screenshot, default=%(default)s")
+    parser.add_argument('--screenshot-kb', type=int, default=100,
+                        help="Size of screenshot responses, default=%(default)s")
+    parser.add_argument('proxy_args', nargs='*', metavar='PROXY OPTIONS',
+                        help="Options for websocket_proxy, after --")
+    args = parser.parse_intermixed_args()
+    asyncio.run(replay(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,58 @@
 import asyncio
+import atexit
+import bisect
+import collections
 import functools
+import gzip
+import hashlib
+import itertools
 import json
+import mimetypes
 import os
 from pathlib import Path
+import random
+import re
+import secrets
+import shutil
+import signal
+import socket
 import ssl
+import sys
+import tempfile
 import textwrap
+import time
+import traceback
 
 import websockets
+from websockets.datastructures import Headers
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+from websockets.http11 import Response
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+try:
+    from .obsauth import check_auth, obs_auth
+except ImportError:   # run as a script: python3 obs_cr/websocket_proxy.py
+    from obsauth import check_auth, obs_auth
 
 
 async def handle(conn):
-    target_url = args.target
-    if not (target_url.startswith('ws://') or target_url.startswith('wss://')):
-        target_url = 'ws://' + target_url
+    name = target_name(conn)
+    if name is None:
+        await conn.close(1008, 'Unknown OBS')   # Policy Violation
+        return
+    target_url = targets[name]
+    metrics = target_metrics.get(name)
     print(f'Connection from {conn.remote_address}')
     #print(path)
     #print(conn.request.headers)
@@ -27,32 +67,79 @@ async def handle(conn):
     ]
     headers = {name: conn.request.headers[name] for name in forward_headers}
     #print(headers)
-    async with websockets.connect(
-        target_url,
-        #additional_headers=headers,
-        subprotocols=conn.request.headers['Sec-WebSocket-Protocol'].split(),
-        #extensions=conn.request.headers['Sec-WebSocket-Extensions'].split(),
-        max_size=10*2**20,
-      ) as target_ws:
+    if coordinator_socket is not None:
+        # --workers: the coordinator has the OBS connections (same path).
+        target = websockets.unix_connect(
+            coordinator_socket, f'ws://localhost{conn.request.path}',
+            additional_headers={'X-Forwarded-For': '%s:%s' % conn.remote_address[:2]},
+            subprotocols=['obswebsocket.json'],
+            compression=None,
+            max_size=10*2**20,
+            )
+    else:
+        target = websockets.connect(
+            target_url,
+            #additional_headers=headers,
+            # Clients may use obswebsocket.msgpack, OBS always gets JSON.
+            subprotocols=['obswebsocket.json'],
+            #extensions=conn.request.headers['Sec-WebSocket-Extensions'].split(),
+            max_size=10*2**20,
+            )
+    async with target as target_ws:
         #await conn.send('test')
+        client_id = next(Client._ids)
+        if recorder: recorder.record(client_id, 'open', conn.request.path)
+        batches = { }
+        sent = { }   # requestId -> (requestType, time sent), for metrics
+        async def send(message, requestType=None):
+            if args.verbose: print(f'>    {shorten(message)} --->')
+            if metrics:
+                metrics.bytes['to_obs'] += len(message)
+                op = peek(message, 'op')
+                request_id = peek(message, 'd', 'requestId') if op in {6, 8} else None
+                if isinstance(request_id, str):
+                    sent[request_id] = (peek(message, 'd', 'requestType') if op == 6 else 'RequestBatch',
+                                        time.perf_counter())
+            await target_ws.send(message)
+        def answer(message):
+            if recorder: recorder.record(client_id, '<', message)
+            asyncio.create_task(conn.send(to_wire(message, conn.subprotocol)))
+        limiter = RateLimiter(args.rate_limits, send, answer, metrics)
         async def forward_messages():
             async for message in conn:
-                if args.verbose: print(f'---> {message}')
-                message = filter_forwarded(message)
+                if metrics: metrics.bytes['from_client'] += len(message)
+                message = from_wire(message, conn.subprotocol)
+                if args.verbose: print(f'---> {shorten(message)}')
+                if recorder: recorder.record(client_id, '>', message)
+                op = peek(message, 'op')
+                requestType = peek(message, 'd', 'requestType') if op == 6 else None
+                if requestType == 'CallVendorRequest' and coordinator_socket is not None:
+                    await send(message)   # the coordinator answers or denies it
+                    continue
+                message = filter_forwarded(message, batches, op, requestType, metrics, deny=answer)
                 if message is None:
                     continue
-                if args.verbose: print(f'>    {message} --->')
-                await target_ws.send(message)
-                await asyncio.sleep(0)
+                if op == 6:
+                    await limiter.request(message, requestType)
+                else:
+                    await send(message)
         async def return_messages():
             async for message in target_ws:
-                if args.verbose: print(f'<    {message} <----')
-                message = filter_returned(message)
+                if args.verbose: print(f'<    {shorten(message)} <----')
+                if metrics:
+                    metrics.bytes['from_obs'] += len(message)
+                    if sent and peek(message, 'op', trusted=True) in {7, 9}:
+                        request = sent.pop(peek(message, 'd', 'requestId', trusted=True), None)
+                        if request is not None:
+                            metrics.observe(request[0], time.perf_counter() - request[1])
+                message = filter_returned(message, batches)
                 if message is None:
                     continue
-                if args.verbose: print(f'<--- {message}')
+                if args.verbose: print(f'<--- {shorten(message)}')
+                if recorder: recorder.record(client_id, '<', message)
+                message = to_wire(message, conn.subprotocol)
+                if metrics: metrics.bytes['to_client'] += len(message)
                 await conn.send(message)
-                await asyncio.sleep(0)
                 #print('done', conn.closed)
         async def wait_closed():
             # Wait for the incoming client to disconnect, then close the server connection.
@@ -60,11 +147,1406 @@ async def handle(conn):
             await conn.wait_closed()
             print(f"Disconnected: {remote_address[0]}:{remote_address[1]}")
             await target_ws.close()
+        if metrics: metrics.connections += 1
         try:
             await asyncio.gather(forward_messages(), return_messages(), wait_closed())
         except (websockets.exceptions.ConnectionClosedOK, websockets.exceptions.ConnectionClosedError) as e:
             print(e.__class__.__name__, str(e))
-            await conn.close()
+            # Pass on why OBS (or the --workers coordinator) closed, like
+            # 4009 AuthenticationFailed.  1005 and 1006 can't be sent.
+            if target_ws.close_code is not None and target_ws.close_code not in {1005, 1006}:
+                await conn.close(target_ws.close_code, target_ws.close_reason)
+            else:
+                await conn.close()
+        finally:
+            limiter.close()
+            if metrics: metrics.connections -= 1
+            if recorder: recorder.record(client_id, 'close')
+
+# Default obs-websocket eventSubscriptions: all non-high-volume events.
+EVENT_SUBSCRIPTIONS_DEFAULT = 0x3ff
+
+
+def shorten(message, length=200):
+    """Message for verbose output: screenshots can be megabytes, so cut unless -vv"""
+    if len(message) <= length or (args.verbose or 0) >= 2:
+        return message
+    return f'{message[:length]}... ({len(message)} bytes)'
+
+
+# Subprotocols offered to clients.  With obswebsocket.msgpack, messages
+# are translated to JSON on the way in and back on the way out, so
+# everything else in the proxy only deals with JSON text.
+SUBPROTOCOLS = ['obswebsocket.json']
+if msgpack is not None:
+    SUBPROTOCOLS.append('obswebsocket.msgpack')
+
+@functools.lru_cache(maxsize=4)
+def to_msgpack(message):
+    """Encode a JSON message as msgpack.
+
+    Cached, because events are fanned out to all clients as the same
+    string, which then needs to be encoded only once.
+    """
+    return msgpack.packb(json.loads(message))
+
+def to_wire(message, subprotocol):
+    """A JSON message as it is sent to a client using `subprotocol`"""
+    if subprotocol == 'obswebsocket.msgpack':
+        return to_msgpack(message)
+    return message
+
+def from_wire(message, subprotocol):
+    """A message from a client using `subprotocol`, as JSON text"""
+    if subprotocol == 'obswebsocket.msgpack':
+        return json.dumps(msgpack.unpackb(message), ensure_ascii=False, separators=(',', ':'))
+    if isinstance(message, bytes):
+        return message.decode()
+    return message
+
+
+# With --workers: path of the coordinator's Unix socket, in the workers.
+coordinator_socket = None
+
+# Target name -> OBS URL.  '' is --obs, the others are from --route and
+# are used for connections to /obs/NAME.
+targets = { }
+
+def target_name(conn):
+    """Name of the target for a connection, by its path, or None if unknown"""
+    path = conn.request.path.split('?')[0]
+    if not path.startswith('/obs/'):
+        return ''
+    name = path[len('/obs/'):].strip('/')
+    return name if name in targets else None
+
+
+class Recorder:
+    """Log of the clients' traffic (--record), for obs_cr.proxy_replay.
+
+    A gzipped file of JSON lines [seconds, client id, direction,
+    message], where direction is '>' from the client, '<' to it, and
+    'open' (message: the path) or 'close' for connections.  Identify
+    authentication is left out, and imageData is replaced by "<N bytes>"
+    unless `screenshots`.  The file is flushed every second.
+
+    The file is appended to.  Each run of the proxy starts with a line
+    {"start": wall-clock time}, since seconds and client ids start
+    again from 0 and 1 in each run.
+    """
+    IMAGE_DATA = re.compile(r'"imageData":\s*"([^"]*)"')
+
+    def __init__(self, path, screenshots=False):
+        self.file = gzip.open(path, 'at')
+        atexit.register(self.file.close)
+        self.screenshots = screenshots
+        self.start = time.monotonic()
+        self.file.write(json.dumps({'start': time.time()}) + '\n')
+
+    def record(self, client, direction, message=None):
+        if direction == '>' and peek(message, 'op') == 1:
+            data = json.loads(message)
+            data['d'].pop('authentication', None)
+            message = json.dumps(data)
+        elif not self.screenshots and message is not None and len(message) > 4096 and '"imageData"' in message:
+            message = self.IMAGE_DATA.sub(lambda m: f'"imageData":"<{len(m.group(1))} bytes>"', message)
+        self.file.write(json.dumps([round(time.monotonic() - self.start, 6), client, direction, message]) + '\n')
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(1)
+            self.file.flush()
+
+recorder = None   # Recorder, with --record
+
+
+_PEEK_PATTERNS = { }
+
+def _peek_match(message, key, trusted=False):
+    """Regex match of `"key": value` in a JSON message, or None if it can't be trusted.
+
+    The match is trusted only if the key occurs exactly once, so that
+    nothing inside a value can pose as the key.  Messages from clients
+    also must not have \\u escapes, which could spell another copy of the
+    key so that the proxy would see a different value than OBS does.
+    (OBS output is `trusted`: its keys are never escaped.)  Values can be
+    strings, numbers, booleans, or null, not containers.
+    """
+    if key not in _PEEK_PATTERNS:
+        _PEEK_PATTERNS[key] = (f'"{key}"', re.compile(
+            rf'"{key}"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+|true|false|null)\s*[,}}]'))
+    quoted, pattern = _PEEK_PATTERNS[key]
+    i = message.find(quoted)
+    if i < 0 or message.find(quoted, i + len(quoted)) >= 0:
+        return None
+    if not trusted and '\\u' in message:
+        return None
+    return pattern.match(message, i)
+
+def _decode(token):
+    """Decode a JSON scalar found by _peek_match"""
+    if token[0] == '"' and '\\' not in token:
+        return token[1:-1]
+    if token.isdigit():
+        return int(token)
+    return json.loads(token)
+
+def peek(message, *path, trusted=False):
+    """Return the value at `path` in a JSON message, without parsing all of it if possible.
+
+    Only the last key of the path is searched for, so this is only for
+    keys with a known place in obs-websocket messages (like 'op' or
+    'requestType').  If that isn't possible, the message is parsed.
+    """
+    m = _peek_match(message, path[-1], trusted)
+    if m is not None:
+        return _decode(m.group(1))
+    data = json.loads(message)
+    try:
+        for key in path:
+            data = data[key]
+    except (KeyError, TypeError):
+        return None
+    return data
+
+def replace_request_id(message, request_id, trusted=False):
+    """Return the message with d.requestId replaced, and the old requestId.
+
+    This doesn't re-serialize the message if possible.
+    """
+    m = _peek_match(message, 'requestId', trusted)
+    if m is not None:
+        return (message[:m.start(1)] + json.dumps(request_id) + message[m.end(1):],
+                _decode(m.group(1)))
+    data = json.loads(message)
+    old_request_id = data['d'].get('requestId')
+    data['d']['requestId'] = request_id
+    return json.dumps(data), old_request_id
+
+
+def local_response(request, response_data=None, code=100, comment=None):
+    """A RequestResponse (op 7) to `request`, answered by the proxy itself"""
+    status = {'result': code == 100, 'code': code}
+    if comment:
+        status['comment'] = comment
+    d = {'requestType': request['requestType'], 'requestStatus': status}
+    if 'requestId' in request:
+        d['requestId'] = request['requestId']
+    if response_data is not None:
+        d['responseData'] = response_data
+    return {'op': 7, 'd': d}
+
+
+class PersistentDataCache:
+    """Read-through cache of profile persistent data (--multiplex mode).
+
+    GetPersistentData is answered from here when possible.  Values are
+    updated by SetPersistentData requests going through the proxy and by
+    CustomEvents for keys which are already cached (panels always
+    broadcast the new value after setting it).  Entries older than `ttl`
+    seconds are read again from OBS, in case something changed them
+    without going through the proxy.
+    """
+    REALM = 'OBS_WEBSOCKET_DATA_REALM_PROFILE'
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.values = { }    # slotName -> (value, time stored)
+        self.writes = collections.Counter()   # slotName -> number of writes seen
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name):
+        """Return (value, time) if there is a fresh value, else None"""
+        entry = self.values.get(name)
+        if entry is None or time.monotonic() - entry[1] > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def set(self, name, value):
+        self.writes[name] += 1
+        self.values[name] = (value, time.monotonic())
+
+    def filler(self, name):
+        """Callback to store a GetPersistentData response for `name`.
+
+        The value is not stored if there was a write after the request was
+        sent, since then the response may be older than what we have.
+        """
+        writes = self.writes[name]
+        def fill(message):
+            response = json.loads(message)['d']
+            if response['requestStatus']['result']:
+                self.fill(name, response.get('responseData', {}).get('slotValue'), writes)
+        return fill
+
+    def fill(self, name, value, writes):
+        """Store a value read from OBS, unless there were writes since `writes`"""
+        if self.writes[name] == writes:
+            self.values[name] = (value, time.monotonic())
+
+    @classmethod
+    def slot_name(cls, request):
+        """slotName of a profile realm Get/SetPersistentData, else None.
+
+        Invalid requests give None, and are forwarded for OBS to fail.
+        """
+        request_data = request.get('requestData')
+        if not isinstance(request_data, dict) or request_data.get('realm') != cls.REALM:
+            return None
+        name = request_data.get('slotName')
+        return name if isinstance(name, str) else None
+
+    def handle_get(self, client, request):
+        """Request handler for GetPersistentData, see Upstream.prepare"""
+        name = self.slot_name(request)
+        if name is None:
+            return True, None
+        entry = self.get(name)
+        if entry is not None:
+            client.send(json.dumps(local_response(request, {'slotValue': entry[0]})))
+            return False, None
+        return True, self.filler(name)
+
+    def handle_set(self, client, request):
+        """Request handler for SetPersistentData, see Upstream.prepare"""
+        name = self.slot_name(request)
+        if name is not None:
+            self.set(name, request['requestData'].get('slotValue'))
+        return True, None
+
+    def on_custom_event(self, event_data):
+        for name, value in event_data.items():
+            if name in self.values:
+                self.set(name, value)
+
+
+class Journal:
+    """Numbered persistent data changes, for catching up (--multiplex mode).
+
+    Each SetPersistentData and CustomEvent gets the next sequence number,
+    and the last `size` of them are kept, so that a client which
+    reconnects can get the changes since the last number it knew of.
+    With `path`, changes are also appended to that file (JSON lines) and
+    read back on start, so numbers survive restarts of the proxy.
+    `epoch` changes when the numbering starts over.  CustomEvents are
+    sent on with their number in eventData[SEQ_KEY].
+    """
+    SEQ_KEY = 'obsCrProxySeq'
+
+    def __init__(self, size, path=None):
+        self.changes = collections.deque(maxlen=size)   # (seq, type, {name: value})
+        self.seq = 0
+        self.epoch = secrets.token_hex(8)
+        self.file = None
+        if path is not None:
+            self.load(path)
+
+    def load(self, path):
+        """Read the changes in `path`, then keep appending to it"""
+        try:
+            with open(path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            lines = [ ]
+        n = 0   # lines read
+        try:
+            if lines:
+                self.epoch = json.loads(lines[0])['epoch']
+                n += 1
+            for line in lines[1:]:
+                seq, type_, data = json.loads(line)
+                self.changes.append((seq, type_, data))
+                self.seq = seq
+                n += 1
+        except (ValueError, KeyError, TypeError) as e:
+            # A partly written last line is lost, anything else starts over.
+            if n < len(lines) - 1:
+                print(f'Journal {path} unreadable, starting over: {e!r}')
+                self.changes.clear()
+                self.seq = 0
+                self.epoch = secrets.token_hex(8)
+        # Rewrite it with only what is kept, so it doesn't grow forever.
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(json.dumps({'epoch': self.epoch}) + '\n')
+            for change in self.changes:
+                f.write(json.dumps(change) + '\n')
+        os.replace(tmp, path)
+        self.file = open(path, 'a', buffering=1)
+
+    def record(self, type_, data):
+        self.seq += 1
+        self.changes.append((self.seq, type_, data))
+        if self.file is not None:
+            self.file.write(json.dumps((self.seq, type_, data)) + '\n')
+
+    def since(self, seq, epoch):
+        """Changes after `seq` as dicts, or None if some were forgotten"""
+        if epoch != self.epoch or seq > self.seq:
+            return None
+        if seq < self.seq and (not self.changes or self.changes[0][0] > seq + 1):
+            return None
+        start = max(0, len(self.changes) - (self.seq - seq))
+        return [{'seq': c[0], 'type': c[1], 'data': c[2]}
+                for c in itertools.islice(self.changes, start, None)]
+
+
+class ScreenshotCoalescer:
+    """Merge identical GetSourceScreenshot requests (--multiplex mode).
+
+    Preview pages all poll screenshots of the same scene, and each one is
+    a separate PNG encode in OBS.  A request joins an identical one
+    (same source, format, size, and quality) which is still in flight,
+    or which was sent less than `window` seconds ago, and gets the same
+    response.
+    """
+    KEYS = ('sourceName', 'sourceUuid', 'imageFormat', 'imageWidth', 'imageHeight',
+            'imageCompressionQuality')
+
+    def __init__(self, window):
+        self.window = window
+        self.groups = { }    # key -> [time sent, response message or None, [(client, request), ...]]
+        self.requests = 0
+        self.merged = 0
+
+    def key(self, request):
+        request_data = request.get('requestData') or { }
+        return tuple(request_data.get(k) for k in self.KEYS)
+
+    @staticmethod
+    def answer(client, request, message):
+        client.send(replace_request_id(message, request.get('requestId'), trusted=True)[0])
+
+    def handle(self, client, request):
+        """Request handler for GetSourceScreenshot, see Upstream.prepare"""
+        if self.join(client, request):
+            return False, None
+        return True, self.start(request)
+
+    def join(self, client, request):
+        """Try to merge with an earlier request.  Return True if merged."""
+        self.requests += 1
+        group = self.groups.get(self.key(request))
+        if group is None:
+            return False
+        sent, response, waiting = group
+        if response is None:
+            waiting.append((client, request))
+        elif time.monotonic() - sent <= self.window:
+            self.answer(client, request, response)
+        else:
+            return False
+        self.merged += 1
+        return True
+
+    def start(self, request):
+        """Start a new group for this request.  Return the response callback."""
+        key = self.key(request)
+        group = self.groups[key] = [time.monotonic(), None, []]
+        def done(message):
+            for client, request in group[2]:
+                self.answer(client, request, message)
+            group[2] = []
+            if peek(message, 'd', 'requestStatus', 'result', trusted=True):
+                group[1] = message
+                asyncio.get_running_loop().call_later(self.window, self._expire, key, group)
+            else:
+                self._expire(key, group)
+        return done
+
+    def _expire(self, key, group):
+        if self.groups.get(key) is group:
+            del self.groups[key]
+
+
+class SceneMirror:
+    """Answer GetSceneList, GetSceneItemList and GetSceneItemId locally (--multiplex mode).
+
+    Pages read the scene list and each scene's items every time they
+    change something.  OBS's responses are kept, and updated from scene
+    and scene item events.  A new scene item can't be filled in from
+    its event, so that scene's items are read from OBS again.  Item
+    transforms in GetSceneItemList are only kept up to date if some
+    client subscribes to SceneItemTransformChanged.
+    """
+    EVENTS = {
+        'SceneListChanged', 'SceneCreated', 'SceneRemoved', 'SceneNameChanged',
+        'CurrentProgramSceneChanged', 'CurrentPreviewSceneChanged', 'InputNameChanged',
+        'SceneItemCreated', 'SceneItemRemoved', 'SceneItemListReindexed',
+        'SceneItemEnableStateChanged', 'SceneItemLockStateChanged', 'SceneItemTransformChanged',
+        }
+    ITEM_FIELDS = {    # event -> the eventData field which is also the item field
+        'SceneItemEnableStateChanged': 'sceneItemEnabled',
+        'SceneItemLockStateChanged': 'sceneItemLocked',
+        'SceneItemTransformChanged': 'sceneItemTransform',
+        }
+
+    def __init__(self):
+        self.scene_list = None   # responseData of GetSceneList
+        self.items = { }   # sceneName -> sceneItems of GetSceneItemList
+        self.changes = 0   # number of events seen, see _forward
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.scene_list = None
+        self.items.clear()
+        self.changes += 1
+
+    def scene_name(self, request_data):
+        """The sceneName of a request, which may have a sceneUuid instead"""
+        if 'sceneName' in request_data:
+            return request_data['sceneName']
+        uuid = request_data.get('sceneUuid')
+        for scene in (self.scene_list or { }).get('scenes', ()):
+            if uuid is not None and scene.get('sceneUuid') == uuid:
+                return scene['sceneName']
+        return None
+
+    def _answer(self, client, request, response_data):
+        self.hits += 1
+        client.send(json.dumps(local_response(request, response_data)))
+        return False, None
+
+    def _forward(self, fill):
+        """Forward a request, and fill(responseData) if nothing changed until the response"""
+        self.misses += 1
+        changes = self.changes
+        def callback(message):
+            response = json.loads(message)['d']
+            if response['requestStatus']['result'] and self.changes == changes:
+                fill(response.get('responseData', { }))
+        return True, callback
+
+    def fill(self, scene_list=None, items=None):
+        if scene_list is not None:
+            self.scene_list = scene_list
+        self.items.update(items or { })
+
+    def handle_scene_list(self, client, request):
+        """Request handler for GetSceneList, see Upstream.prepare"""
+        if self.scene_list is not None:
+            return self._answer(client, request, self.scene_list)
+        return self._forward(self.fill)
+
+    def handle_scene_item_list(self, client, request):
+        """Request handler for GetSceneItemList, see Upstream.prepare"""
+        name = self.scene_name(request.get('requestData') or { })
+        if name in self.items:
+            return self._answer(client, request, {'sceneItems': self.items[name]})
+        if name is None:
+            return True, None
+        return self._forward(lambda data: self.fill(items={name: data.get('sceneItems', [ ])}))
+
+    def handle_scene_item_id(self, client, request):
+        """Request handler for GetSceneItemId, see Upstream.prepare"""
+        request_data = request.get('requestData') or { }
+        name = self.scene_name(request_data)
+        if name in self.items:
+            matches = [item for item in self.items[name]
+                       if item.get('sourceName') == request_data.get('sourceName')]
+            offset = request_data.get('searchOffset', 0)
+            if offset in (-1, *range(len(matches))) and matches:   # -1 is the last match
+                return self._answer(client, request, {'sceneItemId': matches[offset]['sceneItemId']})
+        # Not found, or we don't know: OBS answers, with its own errors.
+        self.misses += 1
+        return True, None
+
+    def _item(self, data):
+        for item in self.items.get(data.get('sceneName'), ()):
+            if item.get('sceneItemId') == data.get('sceneItemId'):
+                return item
+        return None
+
+    def _rename_source(self, old, new):
+        for items in self.items.values():
+            for item in items:
+                if item.get('sourceName') == old:
+                    item['sourceName'] = new
+
+    def on_event(self, eventType, data):
+        """Apply an event (one of EVENTS) with eventData `data`"""
+        self.changes += 1
+        scene_list = self.scene_list
+        if eventType == 'SceneListChanged':
+            if scene_list is not None:
+                scene_list['scenes'] = data.get('scenes', [ ])
+        elif eventType in ('CurrentProgramSceneChanged', 'CurrentPreviewSceneChanged'):
+            if scene_list is not None:
+                which = 'Program' if eventType == 'CurrentProgramSceneChanged' else 'Preview'
+                scene_list[f'current{which}SceneName'] = data.get('sceneName')
+                scene_list[f'current{which}SceneUuid'] = data.get('sceneUuid')
+        elif eventType in ('SceneCreated', 'SceneRemoved'):
+            # Groups are scenes too, but aren't in SceneListChanged.
+            self.items.pop(data.get('sceneName'), None)
+        elif eventType == 'SceneNameChanged':
+            old, new = data.get('oldSceneName'), data.get('sceneName')
+            if old in self.items:
+                self.items[new] = self.items.pop(old)
+            if scene_list is not None:
+                for scene in scene_list.get('scenes', ()):
+                    if scene.get('sceneName') == old:
+                        scene['sceneName'] = new
+                for which in ('Program', 'Preview'):
+                    if scene_list.get(f'current{which}SceneName') == old:
+                        scene_list[f'current{which}SceneName'] = new
+            self._rename_source(old, new)   # scenes in scenes
+        elif eventType == 'InputNameChanged':
+            self._rename_source(data.get('oldInputName'), data.get('inputName'))
+        elif eventType == 'SceneItemCreated':
+            self.items.pop(data.get('sceneName'), None)
+        elif eventType == 'SceneItemRemoved':
+            if data.get('sceneName') in self.items:
+                self.items[data['sceneName']] = [item for item in self.items[data['sceneName']]
+                                                 if item.get('sceneItemId') != data.get('sceneItemId')]
+        elif eventType == 'SceneItemListReindexed':
+            items = self.items.get(data.get('sceneName'))
+            if items is not None:
+                indexes = {item['sceneItemId']: item['sceneItemIndex'] for item in data.get('sceneItems', ())}
+                for item in items:
+                    item['sceneItemIndex'] = indexes.get(item.get('sceneItemId'), item.get('sceneItemIndex'))
+                items.sort(key=lambda item: item.get('sceneItemIndex', 0))
+        else:
+            item = self._item(data)
+            field = self.ITEM_FIELDS[eventType]
+            if item is not None and field in data:
+                item[field] = data[field]
+
+
+# Responses which a newer response to the same request supersedes, when
+# both are still queued for a slow client: requestType -> requestData
+# fields which must match.  The older one is answered with a failure.
+SUPERSEDING_RESPONSES = {
+    'GetSourceScreenshot': ScreenshotCoalescer.KEYS,
+    }
+
+# Events which only carry the latest state of something: a newer one
+# supersedes older ones still queued for a client, if these eventData
+# fields match.  CustomEvents for persistent data keys are handled the
+# same way (see Upstream.route).
+SUPERSEDING_EVENTS = {
+    'InputVolumeMeters': (),
+    'CurrentProgramSceneChanged': (),
+    'InputVolumeChanged': ('inputName',),
+    'InputMuteStateChanged': ('inputName',),
+    'SceneItemEnableStateChanged': ('sceneName', 'sceneItemId'),
+    'SceneItemTransformChanged': ('sceneName', 'sceneItemId'),
+    }
+
+
+class VolumeMeters:
+    """Downsample InputVolumeMeters for clients which asked for a lower rate.
+
+    OBS sends meters about 20 times a second, for every input.  A client
+    can ask for `meterRate` (per second) in Identify/Reidentify, or with
+    the SetMeterRate vendor request.  Clients with the same rate share a
+    group, which holds the peak of each level since it last sent, and
+    sends when 1/rate has passed.  Other clients get every event.
+    """
+    INTENT = 1 << 16   # EventSubscription::InputVolumeMeters
+
+    def __init__(self):
+        self.groups = { }     # rate -> [held inputs {key: input}, time sent, set of clients]
+        self.rates = { }      # client -> rate
+
+    @staticmethod
+    def valid_rate(rate):
+        """rate if it is a positive number, else None"""
+        if isinstance(rate, (int, float)) and not isinstance(rate, bool) and 0 < rate < float('inf'):
+            return rate
+        return None
+
+    def set_rate(self, client, rate):
+        """Set the meter rate of a client.  None, 0 or not a number: all events."""
+        rate = self.valid_rate(rate)
+        old = self.rates.pop(client, None)
+        if old is not None:
+            self.groups[old][2].discard(client)
+            if not self.groups[old][2]:
+                del self.groups[old]
+        if rate:
+            self.rates[client] = rate
+            self.groups.setdefault(rate, [{ }, 0, set()])[2].add(client)
+
+    def on_event(self, message):
+        """Hold peaks of an InputVolumeMeters event, and send to the groups which are due.
+
+        Returns the number of clients sent to.
+        """
+        if not self.groups:
+            return 0
+        inputs = json.loads(message)['d']['eventData']['inputs']
+        now = time.monotonic()
+        n = 0
+        for rate, group in self.groups.items():
+            held = group[0]
+            for input_ in inputs:
+                key = input_.get('inputUuid') or input_.get('inputName')
+                old = held.get(key)
+                if old is not None and len(old['inputLevelsMul']) == len(input_['inputLevelsMul']):
+                    input_ = dict(input_, inputLevelsMul=[
+                        [max(a, b) for a, b in zip(old_levels, levels)]
+                        for old_levels, levels in zip(old['inputLevelsMul'], input_['inputLevelsMul'])])
+                held[key] = input_
+            if now - group[1] < 1 / rate:
+                continue
+            group[0] = { }
+            group[1] = now
+            event = json.dumps({'op': 5, 'd': {'eventType': 'InputVolumeMeters', 'eventIntent': self.INTENT,
+                                               'eventData': {'inputs': list(held.values())}}})
+            for client in group[2]:
+                if client.subscriptions & self.INTENT:
+                    client.send(event, ('InputVolumeMeters', ))
+                    n += 1
+        return n
+
+
+# Default per-client rate limits: requestType -> (requests/second, burst).
+# Changed with --rate-limit.
+RATE_LIMITS = {
+    'SetInputVolume': (20, 10),
+    'SetSceneItemTransform': (20, 10),
+    }
+
+# Setters where only the last value matters: requestType -> requestData
+# fields which identify what is set.  Over the rate limit these aren't
+# rejected, the last one is sent when the limit allows.
+COALESCED_SETTERS = {
+    'SetInputVolume': ('inputName', 'inputUuid'),
+    'SetSceneItemTransform': ('sceneName', 'sceneUuid', 'sceneItemId'),
+    }
+
+
+class RateLimiter:
+    """Token bucket rate limits per requestType, for one client.
+
+    A dragged slider can send hundreds of requests per second.  Requests
+    over the limit are rejected with NotReady, except for
+    COALESCED_SETTERS: those are held back, a newer one for the same
+    thing replaces the held one (which is answered as superseded), and
+    the last one is sent as soon as there is a token.  So the final
+    value always lands.
+
+    `send(message, requestType)` is a coroutine function which forwards
+    a request, `answer(message)` answers the client directly.
+    """
+    def __init__(self, limits, send, answer, metrics=None):
+        self.limits = limits
+        self.send = send
+        self.answer = answer
+        self.metrics = metrics
+        self.buckets = { }    # requestType -> [tokens, time of last update]
+        self.held = { }       # coalescing key -> [request, timer]
+
+    def _take(self, requestType, rate, burst):
+        """Take a token if there is one.  Return 0, or seconds until there is one."""
+        now = time.monotonic()
+        bucket = self.buckets.get(requestType)
+        if bucket is None:
+            bucket = self.buckets[requestType] = [burst, now]
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0
+        return (1 - bucket[0]) / rate
+
+    async def request(self, message, requestType):
+        """Forward a request (op 6), if the limits allow"""
+        limit = self.limits.get(requestType)
+        if limit is None:
+            await self.send(message, requestType)
+            return
+        if requestType in COALESCED_SETTERS:
+            request = json.loads(message)['d']
+            request_data = request.get('requestData') or { }
+            key = (requestType, ) + tuple(request_data.get(k) for k in COALESCED_SETTERS[requestType])
+            if key in self.held:
+                self._replace_held(key, request)
+                return
+        wait = self._take(requestType, *limit)
+        if wait == 0:
+            await self.send(message, requestType)
+        elif requestType in COALESCED_SETTERS:
+            timer = asyncio.get_running_loop().call_later(wait, self._release, key)
+            self.held[key] = [request, timer]
+            if self.metrics: self.metrics.limited[requestType, 'held'] += 1
+        else:
+            if self.metrics: self.metrics.limited[requestType, 'rejected'] += 1
+            self.answer(json.dumps(local_response(json.loads(message)['d'], code=207,   # NotReady
+                                                  comment='Rate limited by proxy, try again')))
+
+    def _replace_held(self, key, request):
+        """A newer request for the same thing replaces the held one"""
+        entry = self.held[key]
+        old = entry[0]
+        # Dict-valued fields (sceneItemTransform) can be partial updates.
+        request_data = request.get('requestData') or { }
+        for name, value in (old.get('requestData') or { }).items():
+            if isinstance(value, dict) and isinstance(request_data.get(name), dict):
+                request_data[name] = {**value, **request_data[name]}
+        entry[0] = request
+        if self.metrics: self.metrics.limited[key[0], 'superseded'] += 1
+        self.answer(json.dumps(local_response(old, comment='Superseded by a newer request')))
+
+    def _release(self, key):
+        request, _ = self.held.pop(key)
+        # The timer was set for when the next token is there, so take it
+        # even if timing makes it not quite there yet.
+        if self._take(key[0], *self.limits[key[0]]):
+            self.buckets[key[0]][0] -= 1
+        asyncio.create_task(self.send(json.dumps({'op': 6, 'd': request}), key[0]))
+
+    def close(self):
+        for _, timer in self.held.values():
+            timer.cancel()
+        self.held.clear()
+
+
+class Client:
+    """One browser/panel connection attached to a shared Upstream.
+
+    Outgoing messages are put into a queue and sent by a separate task,
+    so that one slow client doesn't block routing for all others.  When
+    a client falls behind, queued messages which are superseded by a
+    newer one are dropped (events) or replaced by a short failure
+    (responses, which the client is waiting for).  Other responses are
+    never dropped: if the queue still grows over `max_queue_bytes`, the
+    client is disconnected.
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, conn, max_queue_bytes=64*2**20, metrics=None):
+        self.conn = conn
+        self.metrics = metrics
+        self.id = next(self._ids)
+        self.subscriptions = EVENT_SUBSCRIPTIONS_DEFAULT
+        self.max_queue_bytes = max_queue_bytes
+        self.queue = collections.deque()   # [message, supersede key, replacement]
+        self.queued_bytes = 0
+        self.superseded = 0
+        self._latest = { }   # supersede key -> queue entry
+        self._wakeup = asyncio.Event()
+        self.batches = { }   # state for filter_forwarded/filter_returned
+
+    def send(self, message, supersede=None, replacement=None):
+        """Queue a message.
+
+        If `supersede` is given, an older queued message with the same key
+        is replaced by its `replacement` (None: dropped).
+        """
+        if self.queued_bytes > self.max_queue_bytes:
+            return   # already disconnecting
+        if supersede is not None:
+            old = self._latest.get(supersede)
+            if old is not None:
+                self.queued_bytes -= len(old[0])
+                old[0] = old[2]
+                self.queued_bytes += len(old[0] or '')
+                self.superseded += 1
+        entry = [message, supersede, replacement]
+        if supersede is not None:
+            self._latest[supersede] = entry
+        self.queue.append(entry)
+        self.queued_bytes += len(message)
+        if self.queued_bytes > self.max_queue_bytes:
+            print(f'Client {self.id} too slow, {self.queued_bytes} bytes queued, disconnecting')
+            self.queue.clear()
+            self._latest.clear()
+            asyncio.create_task(self.conn.close(1013, 'Client too slow'))   # Try Again Later
+        self._wakeup.set()
+
+    async def send_messages(self):
+        while True:
+            if not self.queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            entry = self.queue.popleft()
+            message, supersede, _ = entry
+            if supersede is not None and self._latest.get(supersede) is entry:
+                del self._latest[supersede]
+            if message is None:
+                continue
+            self.queued_bytes -= len(message)
+            if args.verbose: print(f'<--- [{self.id}] {shorten(message)}')
+            if recorder: recorder.record(self.id, '<', message)
+            message = to_wire(message, self.conn.subprotocol)
+            if self.metrics: self.metrics.bytes['to_client'] += len(message)
+            await self.conn.send(message)
+
+
+# Request classes, in priority order.  Control requests change what the
+# audience sees and must not wait, so they are always sent at once;
+# only a few state requests are in flight at a time, so that a control
+# request never waits behind many of them; bulk requests (screenshots)
+# are slow for OBS to answer, so only a few are sent at a time too.
+CONTROL, STATE, BULK = 'control', 'state', 'bulk'
+REQUEST_CLASSES = {
+    'GetSourceScreenshot': BULK,
+    }
+
+def request_class(requestType):
+    """CONTROL, STATE, or BULK.  Setters and actions are CONTROL unless listed in REQUEST_CLASSES."""
+    if requestType in REQUEST_CLASSES:
+        return REQUEST_CLASSES[requestType]
+    if requestType.startswith(('Set', 'Trigger', 'Broadcast')):
+        return CONTROL
+    return STATE
+
+
+Pending = collections.namedtuple('Pending', 'client request_id callback supersede request_type sent')
+
+
+class Upstream:
+    """A single authenticated OBS connection shared by many clients.
+
+    The proxy itself does the Identify with OBS.  Each client request
+    gets a new requestId (so that clients can't collide) and the
+    response is routed back to the client with its original requestId.
+    Events are fanned out to every client that subscribed to them.  The
+    upstream subscribes to the union of all client subscriptions.
+
+    If OBS disconnects, client sessions stay open: requests in flight
+    and requests made while disconnected fail with NotReady (which
+    clients can retry), and the upstream reconnects with backoff as long
+    as there are clients.
+
+    OBS answers requests one after another, so a scene switch could
+    wait behind many screenshots or reads.  CONTROL requests (and
+    batches) are sent right away, but only `max_state` STATE and
+    `max_bulk` BULK requests are in flight at a time, and the rest wait
+    in the proxy.
+    """
+    RECONNECT_DELAY_MIN = 0.1
+    RECONNECT_DELAY_MAX = 10
+    def __init__(self, url, password=None, cache=None, screenshots=None, max_bulk=2, metrics=None,
+                 journal=None, scenes=None, max_state=4):
+        self.url = url
+        self.metrics = metrics
+        self.password = password
+        self.cache = cache
+        self.screenshots = screenshots
+        self.scenes = scenes
+        self.ws = None
+        self.hello = None
+        self.clients = set()
+        self.pending = { }    # upstream requestId -> Pending
+        self.state_keys = set()   # keys seen in SetPersistentData
+        self.journal = journal if journal is not None else Journal(0)
+        self.state_keys.update(name for _, type_, data in self.journal.changes
+                               if type_ == 'SetPersistentData' for name in data)
+        self.subscriptions = EVENT_SUBSCRIPTIONS_DEFAULT
+        self._request_ids = itertools.count()
+        self._lock = asyncio.Lock()
+        self._reconnecting = None   # reconnect task
+        # STATE and BULK requests: class -> limit, upstream requestIds in
+        # flight, and (upstream requestId, message) waiting to be sent
+        self.max_in_flight = {STATE: max_state, BULK: max_bulk}
+        self.in_flight = {STATE: set(), BULK: set()}
+        self.queued = {STATE: collections.deque(), BULK: collections.deque()}
+        self.meters = VolumeMeters()
+        # Requests to the proxy itself (CallVendorRequest with vendorName
+        # PROXY_VENDOR): requestType -> async handler(client, requestData)
+        # returning responseData, or raising ValueError for invalid fields.
+        self.vendor_requests = {
+            'SetMeterRate': self._set_meter_rate,
+            'GetPersistentDataSnapshot': self._get_persistent_data_snapshot,
+            'GetPersistentDataChanges': self._get_persistent_data_changes,
+            }
+        # requestType -> handler(client, request) returning (forward, callback).
+        # `forward` is False if the handler answered the request itself,
+        # callback(response message) is called when the response arrives.
+        self.request_handlers = { }
+        if cache is not None:
+            self.request_handlers['GetPersistentData'] = cache.handle_get
+            self.request_handlers['SetPersistentData'] = cache.handle_set
+        if screenshots is not None:
+            self.request_handlers['GetSourceScreenshot'] = screenshots.handle
+        if scenes is not None:
+            self.request_handlers['GetSceneList'] = scenes.handle_scene_list
+            self.request_handlers['GetSceneItemList'] = scenes.handle_scene_item_list
+            self.request_handlers['GetSceneItemId'] = scenes.handle_scene_item_id
+
+    async def connect(self):
+        """Connect and identify, if not already connected"""
+        async with self._lock:
+            if self.ws is not None:
+                return
+            ws = await websockets.connect(
+                self.url,
+                subprotocols=['obswebsocket.json'],
+                max_size=10*2**20,
+                )
+            hello = json.loads(await ws.recv())['d']
+            identify = {'rpcVersion': 1, 'eventSubscriptions': self.subscriptions}
+            if 'authentication' in hello:
+                identify['authentication'] = obs_auth(self.password or '',
+                                                      hello['authentication']['salt'],
+                                                      hello['authentication']['challenge'])
+            await ws.send(json.dumps({'op': 1, 'd': identify}))
+            # OBS closes the connection if authentication failed, which raises here.
+            identified = json.loads(await ws.recv())
+            if identified['op'] != 2:
+                await ws.close()
+                raise ConnectionError(f'Unexpected reply to Identify: {identified}')
+            self.ws = ws
+            self.hello = hello
+            print(f'Upstream connected to {self.url}')
+            asyncio.create_task(self.read_messages())
+            if self.scenes is not None:
+                asyncio.create_task(self.mirror_scenes())
+
+    async def read_messages(self):
+        """Read messages from OBS until it disconnects"""
+        try:
+            async for message in self.ws:
+                if args.verbose: print(f'<    {shorten(message)} <----')
+                if self.metrics: self.metrics.bytes['from_obs'] += len(message)
+                try:
+                    self.route(message)
+                except Exception:   # one bad message mustn't drop the connection
+                    print(f'Error routing {shorten(message)}:')
+                    traceback.print_exc()
+        except websockets.exceptions.ConnectionClosedError as e:
+            print(e.__class__.__name__, str(e))
+        finally:
+            print(f'Upstream disconnected from {self.url}')
+            ws, self.ws = self.ws, None
+            if ws is not None:
+                await ws.close()   # in case we stopped reading for another reason
+            self.fail_pending()
+            if self.cache is not None:
+                self.cache.values.clear()   # OBS may have restarted with other data
+            if self.scenes is not None:
+                self.scenes.clear()
+            self.start_reconnecting()
+
+    async def mirror_scenes(self):
+        """Read the scene list and all scenes' items into the SceneMirror"""
+        changes = self.scenes.changes
+        scene_list = await self.call(6, {'requestType': 'GetSceneList'})
+        if not scene_list['requestStatus']['result']:
+            return
+        names = [scene['sceneName'] for scene in scene_list['responseData']['scenes']]
+        batch = await self.call(8, {'requests': [
+            {'requestType': 'GetSceneItemList', 'requestData': {'sceneName': name}} for name in names]})
+        if self.scenes.changes != changes:
+            return   # requests fill it in later
+        self.scenes.fill(scene_list['responseData'], {
+            name: result['responseData']['sceneItems'] for name, result in zip(names, batch['results'])
+            if result['requestStatus']['result']})
+
+    def start_reconnecting(self):
+        if self._reconnecting is None or self._reconnecting.done():
+            self._reconnecting = asyncio.create_task(self.reconnect())
+
+    async def reconnect(self):
+        """Reconnect with exponential backoff, while there are clients"""
+        delay = self.RECONNECT_DELAY_MIN
+        while self.ws is None and self.clients:
+            await asyncio.sleep(delay * random.uniform(0.5, 1))
+            try:
+                await self.connect()
+            except (OSError, ConnectionError, websockets.exceptions.WebSocketException) as e:
+                print(f'Upstream reconnect to {self.url} failed: {e!r}')
+                delay = min(delay * 2, self.RECONNECT_DELAY_MAX)
+
+    def fail_pending(self):
+        """Answer all requests in flight with NotReady, since OBS won't"""
+        for class_ in self.queued:
+            self.queued[class_].clear()
+            self.in_flight[class_].clear()
+        for request_id, pending in list(self.pending.items()):
+            if pending.request_type == 'RequestBatch':
+                message = {'op': 9, 'd': {'requestId': request_id, 'results': [ ]}}
+            else:
+                message = local_response({'requestType': pending.request_type, 'requestId': request_id},
+                                         code=207, comment='OBS not connected, try again')   # NotReady
+            self.route(json.dumps(message))
+
+    def route(self, message):
+        """Route responses to their clients and fan out events.
+
+        Messages are passed on as they are, except for the requestId
+        which is spliced in, and the journal seq added to CustomEvents.
+        Only small messages like CustomEvents are parsed.
+        """
+        op = peek(message, 'op', trusted=True)
+        if op in {7, 9}:  # RequestResponse, RequestBatchResponse
+            m = _peek_match(message, 'requestId', trusted=True)
+            request_id = _decode(m.group(1)) if m is not None else json.loads(message)['d']['requestId']
+            for in_flight in self.in_flight.values():
+                if request_id in in_flight:
+                    in_flight.discard(request_id)
+                    self._release()
+                    break
+            pending = self.pending.pop(request_id, None)
+            if pending is None:
+                return
+            client = pending.client
+            if self.metrics: self.metrics.observe(pending.request_type, time.perf_counter() - pending.sent)
+            if pending.callback is not None:
+                pending.callback(message)
+            if client is None:   # the proxy's own request, see call()
+                return
+            if m is not None:
+                message = message[:m.start(1)] + json.dumps(pending.request_id) + message[m.end(1):]
+            else:
+                message = replace_request_id(message, pending.request_id)[0]
+            if op == 9:
+                message = filter_returned(message, client.batches)
+            replacement = None
+            if pending.supersede is not None:
+                replacement = json.dumps(local_response(
+                    {'requestType': pending.supersede[0], 'requestId': pending.request_id},
+                    code=207, comment='Superseded by a newer response'))   # NotReady
+            client.send(message, pending.supersede, replacement)
+        elif op == 5:  # Event
+            eventType = peek(message, 'd', 'eventType', trusted=True)
+            supersede = None
+            if eventType == 'CustomEvent':
+                eventData = json.loads(message)['d'].get('eventData', {})
+                self.journal.record('CustomEvent', eventData)
+                if self.cache is not None:
+                    self.cache.on_custom_event(eventData)
+                if eventData and self.state_keys.issuperset(eventData):
+                    supersede = ('CustomEvent', ) + tuple(sorted(eventData))
+                if isinstance(eventData, dict):
+                    message = json.loads(message)
+                    message['d']['eventData'] = dict(eventData, **{Journal.SEQ_KEY: self.journal.seq})
+                    message = json.dumps(message)
+            elif eventType in SUPERSEDING_EVENTS:
+                fields = SUPERSEDING_EVENTS[eventType]
+                eventData = json.loads(message)['d'].get('eventData', {}) if fields else { }
+                supersede = (eventType, ) + tuple(eventData.get(f) for f in fields)
+            if self.scenes is not None and eventType in SceneMirror.EVENTS:
+                self.scenes.on_event(eventType, json.loads(message)['d'].get('eventData', {}))
+            intent = peek(message, 'd', 'eventIntent', trusted=True) or 0
+            n = 0
+            meter_rates = self.meters.rates if eventType == 'InputVolumeMeters' else { }
+            for client in list(self.clients):
+                if (not intent or client.subscriptions & intent) and client not in meter_rates:
+                    client.send(message, supersede)
+                    n += 1
+            if meter_rates:
+                n += self.meters.on_event(message)
+            if self.metrics:
+                self.metrics.events_received[eventType] += 1
+                self.metrics.events_sent[eventType] += n
+
+    def prepare(self, client, message, op, requestType=None):
+        """Prepare a client request (op 6) or batch (op 8) for sending upstream.
+
+        Returns (message with a new requestId, the new requestId), or
+        (None, None) if the request was already answered by the proxy.
+        """
+        callback = None
+        supersede = None
+        if op == 8:
+            for request in json.loads(message)['d']['requests']:
+                if request['requestType'] == 'SetPersistentData':
+                    self._journal_set(request)
+                    if self.cache is not None:
+                        self.cache.handle_set(client, request)
+        else:
+            handler = self.request_handlers.get(requestType)
+            if handler is not None or requestType in SUPERSEDING_RESPONSES or requestType == 'SetPersistentData':
+                request = json.loads(message)['d']
+                request_data = request.get('requestData')
+                if not isinstance(request_data, dict):
+                    request_data = { }   # OBS fails the request
+                if requestType == 'SetPersistentData':
+                    self._journal_set(request)
+                if requestType in SUPERSEDING_RESPONSES:
+                    supersede = (requestType, ) + tuple(request_data.get(k) for k in SUPERSEDING_RESPONSES[requestType])
+                if handler is not None:
+                    forward, callback = handler(client, request)
+                    if not forward:
+                        return None, None
+        request_id = str(next(self._request_ids))
+        message, client_request_id = replace_request_id(message, request_id)
+        self.pending[request_id] = Pending(client, client_request_id, callback, supersede,
+                                           requestType or 'RequestBatch', time.perf_counter())
+        return message, request_id
+
+    def _journal_set(self, request):
+        """Journal a SetPersistentData of the profile realm (the only one pages use)"""
+        name = PersistentDataCache.slot_name(request)
+        if name is not None:
+            self.journal.record('SetPersistentData', {name: request['requestData'].get('slotValue')})
+            self.state_keys.add(name)
+
+    async def request(self, client, message, op, requestType=None):
+        """Send a client request upstream, or queue it if it is STATE or BULK"""
+        message, request_id = self.prepare(client, message, op, requestType)
+        if message is None:
+            return
+        class_ = request_class(requestType) if op == 6 else CONTROL
+        if class_ != CONTROL:
+            self.queued[class_].append((request_id, message))
+            self._release()
+            return
+        await self.send(message)
+
+    def _release(self):
+        """Send queued STATE and BULK requests while there is room"""
+        for class_ in (STATE, BULK):
+            queued, in_flight = self.queued[class_], self.in_flight[class_]
+            while queued and len(in_flight) < self.max_in_flight[class_]:
+                request_id, message = queued.popleft()
+                if request_id in self.pending:   # else the client is gone, and nobody waits for it
+                    in_flight.add(request_id)
+                    asyncio.create_task(self.send(message))
+
+    async def send(self, message):
+        if self.ws is None:
+            self.fail_pending()
+            return
+        if args.verbose: print(f'>    {shorten(message)} --->')
+        if self.metrics: self.metrics.bytes['to_obs'] += len(message)
+        try:
+            await self.ws.send(message)
+        except websockets.exceptions.ConnectionClosed:
+            self.fail_pending()
+
+    async def call(self, op, d):
+        """Send a request (op 6) or batch (op 8) of the proxy itself, and return the `d` of the response"""
+        request_id = str(next(self._request_ids))
+        response = asyncio.get_running_loop().create_future()
+        def done(message):
+            if not response.done():
+                response.set_result(json.loads(message)['d'])
+        self.pending[request_id] = Pending(None, None, done, None,
+                                           d.get('requestType', 'RequestBatch'), time.perf_counter())
+        await self.send(json.dumps({'op': op, 'd': dict(d, requestId=request_id)}))
+        return await response
+
+    async def _set_meter_rate(self, client, request_data):
+        rate = request_data.get('meterRate')
+        if rate not in (None, 0) and self.meters.valid_rate(rate) is None:
+            raise ValueError('meterRate must be a positive number')
+        self.meters.set_rate(client, rate)
+        return {'meterRate': self.meters.rates.get(client)}
+
+    async def _get_persistent_data_snapshot(self, client, request_data):
+        """All known persistent data (whose names start with `prefix`), and `slotNames`.
+
+        Values which aren't cached are read from OBS in one batch.  `seq`
+        is the journal's last change when the cached values were read:
+        changes recorded while reading the others may be in the snapshot
+        already, but catching up from `seq` replays them anyway, so none
+        are missed.
+        """
+        epoch, seq = self.journal.epoch, self.journal.seq
+        prefix = request_data.get('prefix', '')
+        slot_names = request_data.get('slotNames', [ ])
+        if not isinstance(prefix, str):
+            raise ValueError('prefix must be a string')
+        if not isinstance(slot_names, list) or not all(isinstance(name, str) for name in slot_names):
+            raise ValueError('slotNames must be a list of strings')
+        known = set(self.state_keys)
+        if self.cache is not None:
+            known.update(self.cache.values)
+        names = {name for name in known if isinstance(name, str) and name.startswith(prefix)}
+        names.update(slot_names)
+        slots = { }
+        missing = [ ]
+        for name in sorted(names):
+            entry = self.cache.get(name) if self.cache is not None else None
+            if entry is None:
+                missing.append(name)
+            else:
+                slots[name] = entry[0]
+        if missing:
+            writes = {name: self.cache.writes[name] for name in missing} if self.cache is not None else { }
+            response = await self.call(8, {'requests': [
+                {'requestType': 'GetPersistentData',
+                 'requestData': {'realm': PersistentDataCache.REALM, 'slotName': name}}
+                for name in missing]})
+            for name, result in zip(missing, response['results']):
+                if not result['requestStatus']['result']:
+                    continue
+                slots[name] = result.get('responseData', {}).get('slotValue')
+                if self.cache is not None:
+                    self.cache.fill(name, slots[name], writes[name])
+                    slots[name] = self.cache.values[name][0]   # may be newer
+        return {'epoch': epoch, 'seq': seq, 'slots': slots}
+
+    async def _get_persistent_data_changes(self, client, request_data):
+        """Changes since `seq` (of `epoch`), or a snapshot if they aren't all known"""
+        seq = request_data.get('seq', 0)
+        if not isinstance(seq, int) or isinstance(seq, bool):
+            raise ValueError('seq must be an integer')
+        changes = self.journal.since(seq, request_data.get('epoch'))
+        if changes is None:
+            return await self._get_persistent_data_snapshot(client, request_data)
+        return {'epoch': self.journal.epoch, 'seq': self.journal.seq, 'changes': changes}
+
+    async def vendor_request(self, client, request):
+        """Answer a CallVendorRequest to the proxy (the `d` of op 6), see vendor_requests"""
+        call = request.get('requestData') or { }
+        request_type = call.get('requestType') if isinstance(call, dict) else None
+        handler = self.vendor_requests.get(request_type) if isinstance(request_type, str) else None
+        if handler is None:
+            response = local_response(request, code=204,   # UnknownRequestType
+                                      comment=f'Unknown {PROXY_VENDOR} request')
+        else:
+            try:
+                request_data = call.get('requestData') or { }
+                if not isinstance(request_data, dict):
+                    raise ValueError('requestData must be an object')
+                response_data = await handler(client, request_data)
+            except ValueError as e:
+                response = local_response(request, code=400, comment=str(e))   # InvalidRequestField
+            except Exception as e:   # the client must get an answer anyway
+                print(f'Error in {PROXY_VENDOR} request {call["requestType"]}:')
+                traceback.print_exc()
+                response = local_response(request, code=702,   # RequestProcessingFailed
+                                          comment=f'{e.__class__.__name__}: {e}')
+            else:
+                response = local_response(request, {
+                    'vendorName': PROXY_VENDOR, 'requestType': call['requestType'],
+                    'responseData': response_data})
+        client.send(json.dumps(response))
+
+    async def attach(self, client):
+        self.clients.add(client)
+        await self.update_subscriptions()
+
+    async def detach(self, client):
+        self.clients.discard(client)
+        self.meters.set_rate(client, None)
+        for request_id, pending in list(self.pending.items()):
+            if pending.client is client:
+                if pending.callback is not None:
+                    # Others may wait for the response (e.g. coalesced
+                    # screenshots): keep it, without the client.  This also
+                    # keeps it queued, see _release.
+                    self.pending[request_id] = pending._replace(client=None)
+                else:
+                    del self.pending[request_id]
+        await self.update_subscriptions()
+
+    async def update_subscriptions(self):
+        """Reidentify upstream if the union of client subscriptions changed"""
+        subscriptions = EVENT_SUBSCRIPTIONS_DEFAULT
+        for client in self.clients:
+            subscriptions |= client.subscriptions
+        if subscriptions != self.subscriptions:
+            # If disconnected, the next Identify uses these.
+            self.subscriptions = subscriptions
+            if self.ws is not None:
+                await self.ws.send(json.dumps({'op': 3, 'd': {'eventSubscriptions': subscriptions}}))
+
+
+upstreams = { }   # target name -> Upstream, with --multiplex
+
+# vendorName of CallVendorRequests which the proxy answers itself
+PROXY_VENDOR = 'obs-cr-proxy'
+
+
+async def handle_multiplexed(conn):
+    """Handle one client in --multiplex mode.
+
+    The proxy acts as the obs-websocket server towards the client
+    (Hello/Identify), then sends requests through the shared upstream.
+    """
+    upstream = upstreams.get(target_name(conn))
+    if upstream is None:
+        await conn.close(1008, 'Unknown OBS')   # Policy Violation
+        return
+    metrics = upstream.metrics
+    remote_address = conn.remote_address
+    if not remote_address:   # from a --workers worker
+        remote_address = tuple(conn.request.headers.get('X-Forwarded-For', '?:?').rsplit(':', 1))
+    print(f'Connection from {remote_address}')
+    try:
+        await upstream.connect()
+    except (OSError, ConnectionError, websockets.exceptions.WebSocketException) as e:
+        print(f'Upstream connection to {upstream.url} failed: {e!r}')
+        if upstream.hello is None:
+            # Never connected, so we can't even say which version to expect.
+            await conn.close(1011, 'OBS not available')
+            return
+    hello = {'obsWebSocketVersion': upstream.hello.get('obsWebSocketVersion'), 'rpcVersion': 1}
+    password = args.client_password or args.password
+    if password:
+        hello['authentication'] = {'challenge': secrets.token_urlsafe(32),
+                                   'salt': secrets.token_urlsafe(32)}
+    await conn.send(to_wire(json.dumps({'op': 0, 'd': hello}), conn.subprotocol))
+    try:
+        identify = json.loads(from_wire(await conn.recv(), conn.subprotocol))
+    except websockets.exceptions.ConnectionClosed:
+        return
+    if identify['op'] != 1:
+        await conn.close(4007, 'Not identified')   # NotIdentified
+        return
+    if password and not check_auth(identify['d'].get('authentication'), password,
+                                   hello['authentication']['salt'], hello['authentication']['challenge']):
+        print(f'Authentication failed: {remote_address}')
+        await conn.close(4009, 'Authentication failed')   # AuthenticationFailed
+        return
+
+    client = Client(conn, max_queue_bytes=args.client_queue_mb*2**20, metrics=metrics)
+    limiter = RateLimiter(args.rate_limits,
+                          lambda message, requestType: upstream.request(client, message, 6, requestType),
+                          client.send, metrics)
+    client.subscriptions = identify['d'].get('eventSubscriptions', EVENT_SUBSCRIPTIONS_DEFAULT)
+    upstream.meters.set_rate(client, identify['d'].get('meterRate'))
+    if recorder:
+        recorder.record(client.id, 'open', conn.request.path)
+        recorder.record(client.id, '>', json.dumps(identify))
+    await conn.send(to_wire(json.dumps({'op': 2, 'd': {'negotiatedRpcVersion': 1}}), conn.subprotocol))
+    await upstream.attach(client)
+    if upstream.ws is None:
+        upstream.start_reconnecting()
+    sender = asyncio.create_task(client.send_messages())
+    if metrics: metrics.connections += 1
+    try:
+        async for message in conn:
+            if metrics: metrics.bytes['from_client'] += len(message)
+            message = from_wire(message, conn.subprotocol)
+            if args.verbose: print(f'---> [{client.id}] {shorten(message)}')
+            if recorder: recorder.record(client.id, '>', message)
+            op = peek(message, 'op')
+            if op == 3:  # Reidentify
+                reidentify = json.loads(message)['d']
+                client.subscriptions = reidentify.get('eventSubscriptions', client.subscriptions)
+                if 'meterRate' in reidentify:
+                    upstream.meters.set_rate(client, reidentify['meterRate'])
+                await upstream.update_subscriptions()
+                client.send(json.dumps({'op': 2, 'd': {'negotiatedRpcVersion': 1}}))
+                continue
+            if op not in {6, 8}:
+                continue
+            requestType = peek(message, 'd', 'requestType') if op == 6 else None
+            if requestType == 'CallVendorRequest':
+                request = json.loads(message)['d']
+                if (request.get('requestData') or { }).get('vendorName') == PROXY_VENDOR:
+                    asyncio.create_task(upstream.vendor_request(client, request))
+                    continue
+            message = filter_forwarded(message, client.batches, op, requestType, metrics, deny=client.send)
+            if message is None:
+                continue
+            if op == 6:
+                await limiter.request(message, requestType)
+            else:
+                await upstream.request(client, message, op)
+    except (websockets.exceptions.ConnectionClosedOK, websockets.exceptions.ConnectionClosedError) as e:
+        print(e.__class__.__name__, str(e))
+    finally:
+        if metrics: metrics.connections -= 1
+        limiter.close()
+        sender.cancel()
+        await upstream.detach(client)
+        await conn.close()
+        if recorder: recorder.record(client.id, 'close')
+        print(f"Disconnected: {remote_address[0]}:{remote_address[1]}")
+
 
 ALLOWED_REQUESTS = set("""
     GetVersion
@@ -98,68 +1580,478 @@ ALLOWED_REQUESTS = set("""
     GetSourceScreenshot
 """.split())
 
-def filter_forwarded(message):
-    data = json.loads(message)
-    if data['op'] in {0, 1}:  # Hello, Identify
+# Returned by request checks when the request was allowed but modified,
+# so that it must be serialized again.
+REWRITTEN = 'rewritten'
+
+def check_input_settings(request):
+    """Policy for SetInputSettings: only some settings and safe local_file paths"""
+    # Carefully validate inputSettings
+    inputSettings = request['requestData']['inputSettings']
+    # Verify all other inputSettings arguments ane in this allowed list.
+    if len(set(inputSettings) - set('local_file overlay text font'.split())) > 0:
+        return 400, 'inputSettings not allowed by proxy'   # InvalidRequestField
+    # Verify the local_file argument is a safe path.
+    if 'local_file' in inputSettings:
+        local_file = Path(inputSettings['local_file']).expanduser().resolve()
+        # If it starts with /home/rkdarst/, change to ~/ for this computer
+        if local_file.is_relative_to('/home/rkdarst/'):
+            local_file = ('~/' / local_file.relative_to('/home/rkdarst/')).expanduser().resolve()
+        # Check the path, ensure it's in ~/git/coderefinery-artwork.
+        # Symlinks, '..', etc. should have been expanded above.
+        if not local_file.is_relative_to(Path('~/git/coderefinery-artwork').expanduser()):
+            # If it's not in this git repo, exclude
+            print(f'exclude suspicious local_file={local_file}')
+            return 400, 'local_file not allowed by proxy'   # InvalidRequestField
+        # Take our normalized local_file
+        if inputSettings['local_file'] != str(local_file):
+            inputSettings['local_file'] = str(local_file)
+            return REWRITTEN
+    # Now fully validated
+    return None
+
+# Per-requestType policy: None means always allowed, otherwise a
+# function(request) which returns None (allowed), REWRITTEN (allowed
+# after modifying the request), or (code, comment) if denied.
+REQUEST_POLICY = dict.fromkeys(ALLOWED_REQUESTS)
+REQUEST_POLICY['SetInputSettings'] = check_input_settings
+
+def check_request(request):
+    """Check one request (the `d` of op 6, or one request of a batch) by REQUEST_POLICY"""
+    requestType = request['requestType']
+    if requestType not in REQUEST_POLICY:
+        print(requestType)
+        return 204, 'requestType not allowed by proxy'   # UnknownRequestType
+    check = REQUEST_POLICY[requestType]
+    if check is None:
+        return None
+    return check(request)
+
+def filter_batch(batch, metrics=None):
+    """Apply check_request to every request of a RequestBatch (the `d` of op 8).
+
+    Only the allowed requests are forwarded, in the same batch.  If
+    haltOnFailure is set, requests after the first denied one aren't
+    forwarded either, since OBS wouldn't have run them.  Returns
+    (allowed_batch, complete), where complete(results) makes the results
+    of the full batch out of the results of the allowed batch, with the
+    denied requests failed in their original positions.
+    """
+    halt = batch.get('haltOnFailure', False)
+    requests = [ ]
+    allowed = [ ]
+    denied = { }   # index -> result
+    for i, request in enumerate(batch['requests']):
+        requests.append(request)
+        denial = check_request(request)
+        if metrics: metrics.count_request(request['requestType'], denial)
+        if denial is None or denial == REWRITTEN:
+            allowed.append(request)
+            continue
+        denied[i] = local_response(request, code=denial[0], comment=denial[1])['d']
+        if halt:
+            break
+    if denied and not allowed:
+        # Send a harmless placeholder, so that the response comes back
+        # the normal way.  Its result is dropped by complete().
+        allowed = [{'requestType': 'GetVersion'}]
+    allowed_batch = dict(batch, requests=allowed)
+    if not denied:
+        return allowed_batch, None
+
+    def complete(results):
+        results = iter(results)
+        full_results = [ ]
+        for i, request in enumerate(requests):
+            if i in denied:
+                full_results.append(denied[i])
+                if halt:
+                    break
+                continue
+            result = next(results, None)
+            if result is None:   # OBS halted the batch
+                break
+            full_results.append(result)
+            if halt and not result['requestStatus']['result']:
+                break
+        return full_results
+    return allowed_batch, complete
+
+def filter_forwarded(message, batches=None, op=None, requestType=None, metrics=None, deny=None):
+    """Filter a message from the client.  Return the message to forward, or None.
+
+    Most requests are allowed by their requestType alone, and are
+    passed on without parsing or re-serializing.
+
+    `batches` is a dict of per-connection state, which is needed to
+    allow RequestBatch: the response must then be completed by
+    filter_returned with the same dict.  `op` and `requestType` can be
+    given if the caller already knows them.  Requests are counted in
+    `metrics`, if given.  deny(response message) is called with the
+    failure response to a denied request, if given.
+    """
+    if op is None:
+        op = peek(message, 'op')
+    if op in {0, 1}:  # Hello, Identify
         print(message)
         return message
-    if data['op'] in {2, 3}: # Identify, Reidentify
+    if op in {2, 3}: # Identify, Reidentify
         return message
-    if data['op'] == 5:  # Event from OBS->client (shouldn't appear here)
+    if op == 5:  # Event from OBS->client (shouldn't appear here)
         pass
-    if data['op'] == 6:
+    if op == 6:
         # request
-        request = data['d']
-        requestType = request['requestType']
-        if requestType == 'SetInputSettings':
-            # Carefully validate inputSettings
-            inputSettings = request['requestData']['inputSettings']
-            # Verify all other inputSettings arguments ane in this allowed list.
-            if len(set(inputSettings) - set('local_file overlay text font'.split())) > 0:
-                print('denied message:', message)
-                return
-            # Verify the local_file argument is a safe path.
-            if 'local_file' in inputSettings:
-                local_file = Path(inputSettings['local_file']).expanduser().resolve()
-                # If it starts with /home/rkdarst/, change to ~/ for this computer
-                if local_file.is_relative_to('/home/rkdarst/'):
-                    local_file = ('~/' / local_file.relative_to('/home/rkdarst/')).expanduser().resolve()
-                # Check the path, ensure it's in ~/git/coderefinery-artwork.
-                # Symlinks, '..', etc. should have been expanded above.
-                if not local_file.is_relative_to(Path('~/git/coderefinery-artwork').expanduser()):
-                    # If it's not in this git repo, exclude
-                    print('denied message:', message)
-                    print(f'exclude suspicious local_file={local_file}')
-                    return
-                # Take our normalized local_file
-                inputSettings['local_file'] = str(local_file)
-                message = json.dumps(data)
-            # Now fully validated
-            return(message)
-            return None
-        if requestType in ALLOWED_REQUESTS:
+        if requestType is None:
+            requestType = peek(message, 'd', 'requestType')
+        if requestType in REQUEST_POLICY and REQUEST_POLICY[requestType] is None:
+            if metrics: metrics.requests[requestType, 'allowed'] += 1
             return message
-        print(requestType)
-    if data['op'] == 8:
+        data = json.loads(message)
+        denial = check_request(data['d'])
+        if metrics: metrics.count_request(requestType, denial)
+        if denial is None:
+            return message
+        if denial == REWRITTEN:
+            return json.dumps(data)
+        print('denied message:', message)
+        if deny is not None:
+            deny(json.dumps(local_response(data['d'], code=denial[0], comment=denial[1])))
+        return None
+    if op == 8 and batches is not None:
         # batch
-        submessages = data['requests']
-        print("Batch not supported yet")
-        #return message
+        data = json.loads(message)
+        allowed_batch, complete = filter_batch(data['d'], metrics)
+        if complete is not None:
+            print('denied batch requests:', message)
+            batches[data['d'].get('requestId')] = complete
+        return json.dumps({'op': 8, 'd': allowed_batch})
     print(message)
     return None
 
-def filter_returned(message):
+def filter_returned(message, batches=None):
+    """Filter a message from OBS.  Return the message to send to the client, or None"""
+    if batches and peek(message, 'op', trusted=True) == 9:  # RequestBatchResponse
+        data = json.loads(message)
+        complete = batches.pop(data['d'].get('requestId'), None)
+        if complete is not None:
+            data['d']['results'] = complete(data['d']['results'])
+            message = json.dumps(data)
     return message
 
-async def main2(target_url):
+class Metrics:
+    """Counters for the --metrics endpoint, in the Prometheus text format.
+
+    Recording is only dict increments (and a bisect for latencies), so
+    that it costs next to nothing per message.  Everything is formatted
+    when the endpoint is scraped.
+    """
+    # Upper bounds of the request latency histogram buckets, seconds
+    BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, upstream=None):
+        self.upstream = upstream   # for its own counters, with --multiplex
+        self.requests = collections.Counter()   # (requestType, 'allowed'/'denied') -> n
+        self.latency = { }    # requestType -> [count per bucket (the last is +Inf)..., sum]
+        self.bytes = collections.Counter()      # direction -> bytes
+        self.events_received = collections.Counter()   # eventType -> n
+        self.events_sent = collections.Counter()       # eventType -> n, summed over clients
+        self.limited = collections.Counter()    # (requestType, 'held'/'superseded'/'rejected') -> n
+        self.connections = 0
+
+    def count_request(self, requestType, denial):
+        """Count a request checked by check_request"""
+        if requestType not in REQUEST_POLICY:
+            requestType = 'other'   # don't let clients invent labels
+        self.requests[requestType, 'allowed' if denial is None or denial == REWRITTEN else 'denied'] += 1
+
+    def observe(self, requestType, seconds):
+        """Record the upstream round-trip time of a request"""
+        counts = self.latency.get(requestType)
+        if counts is None:
+            counts = self.latency[requestType] = [0] * (len(self.BUCKETS) + 2)
+        counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        counts[-1] += seconds
+
+    def families(self):
+        """All metrics, as (name, type, help, [(suffix, labels, value), ...])"""
+        yield ('requests_total', 'counter', 'Requests from clients by requestType and whether they were allowed',
+               [('', {'requestType': t, 'result': r}, n) for (t, r), n in sorted(self.requests.items())])
+        histogram = [ ]
+        for requestType, counts in sorted(self.latency.items()):
+            total = 0
+            for le, n in zip(self.BUCKETS + ('+Inf', ), counts):
+                total += n
+                histogram.append(('_bucket', {'requestType': requestType, 'le': le}, total))
+            histogram.append(('_sum', {'requestType': requestType}, counts[-1]))
+            histogram.append(('_count', {'requestType': requestType}, total))
+        yield 'request_duration_seconds', 'histogram', 'Round-trip time of requests to OBS', histogram
+        yield ('rate_limited_total', 'counter',
+               'Requests over the rate limit: held back, superseded while held, or rejected',
+               [('', {'requestType': t, 'action': a}, n) for (t, a), n in sorted(self.limited.items())])
+        yield ('bytes_total', 'counter', 'Message bytes by direction',
+               [('', {'direction': d}, n) for d, n in sorted(self.bytes.items())])
+        yield 'client_connections', 'gauge', 'Connected clients', [('', { }, self.connections)]
+        yield ('events_received_total', 'counter', 'Events received from OBS (--multiplex)',
+               [('', {'eventType': t}, n) for t, n in sorted(self.events_received.items())])
+        yield ('events_sent_total', 'counter', 'Events sent to clients, summed over clients (--multiplex)',
+               [('', {'eventType': t}, n) for t, n in sorted(self.events_sent.items())])
+        upstream = self.upstream
+        if upstream is None:
+            return
+        yield ('upstream_connected', 'gauge', 'Whether the shared OBS connection is up',
+               [('', { }, int(upstream.ws is not None))])
+        yield ('bulk_requests', 'gauge', 'Bulk (screenshot) requests in flight and waiting',
+               [('', {'state': 'in_flight'}, len(upstream.in_flight[BULK])),
+                ('', {'state': 'queued'}, len(upstream.queued[BULK]))])
+        yield ('state_requests', 'gauge', 'State (read) requests in flight and waiting',
+               [('', {'state': 'in_flight'}, len(upstream.in_flight[STATE])),
+                ('', {'state': 'queued'}, len(upstream.queued[STATE]))])
+        yield ('superseded', 'gauge', 'Queued messages dropped or replaced by newer ones, for connected clients',
+               [('', { }, sum(c.superseded for c in upstream.clients))])
+        if upstream.cache is not None:
+            yield ('persistent_data_cache_total', 'counter', 'GetPersistentData answered from the cache',
+                   [('', {'result': 'hit'}, upstream.cache.hits), ('', {'result': 'miss'}, upstream.cache.misses)])
+        if upstream.scenes is not None:
+            yield ('scene_mirror_total', 'counter', 'GetSceneList etc. answered from the scene mirror',
+                   [('', {'result': 'hit'}, upstream.scenes.hits), ('', {'result': 'miss'}, upstream.scenes.misses)])
+        if upstream.screenshots is not None:
+            yield ('screenshot_requests_total', 'counter', 'GetSourceScreenshot requests',
+                   [('', { }, upstream.screenshots.requests)])
+            yield ('screenshot_merged_total', 'counter', 'GetSourceScreenshot requests merged with another',
+                   [('', { }, upstream.screenshots.merged)])
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+target_metrics = { }   # target name -> Metrics, with --metrics
+
+def format_metrics():
+    """Metrics of all targets, as the text of a Prometheus scrape.
+
+    Every sample gets an `obs` label with the target name (see --route).
+    """
+    families = { }   # name -> (type, help, lines)
+    for target, metrics in target_metrics.items():
+        for name, type_, help_, samples in metrics.families():
+            lines = families.setdefault(name, (type_, help_, [ ]))[2]
+            for suffix, labels, value in samples:
+                labels = ','.join(f'{k}="{_escape_label(v)}"'
+                                  for k, v in dict(obs=target or 'default', **labels).items())
+                lines.append(f'obs_proxy_{name}{suffix}{{{labels}}} {value}')
+    text = [ ]
+    for name, (type_, help_, lines) in families.items():
+        text.append(f'# HELP obs_proxy_{name} {help_}')
+        text.append(f'# TYPE obs_proxy_{name} {type_}')
+        text.extend(lines)
+    return '\n'.join(text) + '\n'
+
+async def serve_metrics(reader, writer):
+    """Minimal HTTP server for the --metrics endpoint"""
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():   # skip headers
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[1].split(b'?')[0] in {b'/', b'/metrics'}:
+            status, body = '200 OK', format_metrics().encode()
+        else:
+            status, body = '404 Not Found', b'Not found\n'
+        writer.write(f'HTTP/1.0 {status}\r\n'
+                     f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except (OSError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+class StaticFiles:
+    """Serve the files of a directory (--web) on the proxy's port.
+
+    All files are read when the proxy starts, with gzip and (if the
+    brotli module is installed) brotli variants where those are smaller,
+    and a strong ETag of the content.  config.yaml is served as JSON,
+    which the pages parse without js-yaml.  Pages, scripts and config
+    are revalidated on each load (a 304 if unchanged, since their URLs
+    don't change with their content); other files are cached for a day.
+    Changes to the directory need a restart of the proxy.
+    """
+    REVALIDATE = {'.html', '.js', '.css', '.yaml', '.json'}
+    MAX_AGE = 86400
+
+    def __init__(self, root):
+        self.files = { }   # URL path -> (headers, ETag, {encoding: body})
+        root = Path(root)
+        for dirpath, dirnames, filenames in os.walk(root, followlinks=True):   # web/sound is a link
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                if not filename.startswith('.'):
+                    path = Path(dirpath, filename)
+                    self.add('/' + path.relative_to(root).as_posix(), path)
+        if '/index.html' in self.files:
+            self.files['/'] = self.files['/index.html']
+
+    def add(self, url, path):
+        body = path.read_bytes()
+        content_type = mimetypes.guess_type(path.name)[0] or 'application/octet-stream'
+        if path.suffix == '.yaml' and yaml is not None:
+            body = json.dumps(yaml.safe_load(body)).encode()
+            content_type = 'application/json'
+        if content_type.startswith('text/') or content_type in {'application/javascript', 'application/json'}:
+            content_type += '; charset=utf-8'
+        bodies = {'identity': body}
+        compressed = {'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            compressed['br'] = brotli.compress(body)
+        for encoding, data in compressed.items():
+            if len(data) < len(body) * 0.9:
+                bodies[encoding] = data
+        cache = 'no-cache' if path.suffix in self.REVALIDATE else f'public, max-age={self.MAX_AGE}'
+        headers = {'Content-Type': content_type, 'Cache-Control': cache, 'Vary': 'Accept-Encoding',
+                   'Accept-Ranges': 'bytes'}
+        self.files[url] = (headers, hashlib.sha256(body).hexdigest()[:32], bodies)
+
+    @staticmethod
+    def accepted(header):
+        """The content codings in an Accept-Encoding header"""
+        encodings = set()
+        for item in header.split(','):
+            coding, _, params = item.partition(';')
+            if not re.search(r'q\s*=\s*0(\.0*)?\s*$', params):
+                encodings.add(coding.strip().lower())
+        return encodings
+
+    def response(self, request):
+        """The Response to a GET request"""
+        path = request.path.split('?', 1)[0]
+        entry = self.files.get(path)
+        if entry is None:
+            return Response(404, 'Not Found', Headers({'Content-Type': 'text/plain'}), b'Not found\n')
+        headers, etag, bodies = entry
+        encoding = 'identity'
+        if 'Range' not in request.headers:   # ranges are of the identity body
+            accepted = self.accepted(request.headers.get('Accept-Encoding', ''))
+            encoding = next((e for e in ('br', 'gzip') if e in bodies and e in accepted), 'identity')
+        etag = f'"{etag}"' if encoding == 'identity' else f'"{etag}-{encoding}"'
+        response_headers = Headers(headers, ETag=etag)
+        if etag in request.headers.get('If-None-Match', ''):
+            return Response(304, 'Not Modified', response_headers)
+        body = bodies[encoding]
+        if encoding != 'identity':
+            response_headers['Content-Encoding'] = encoding
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', request.headers.get('Range', ''))
+        if match and any(match.groups()):   # Safari needs these for <audio>
+            start, end = match.groups()
+            if not start:
+                start, end = max(0, len(body) - int(end)), len(body) - 1
+            start, end = int(start), min(int(end or len(body) - 1), len(body) - 1)
+            if start > end:
+                response_headers['Content-Range'] = f'bytes */{len(body)}'
+                return Response(416, 'Range Not Satisfiable', response_headers)
+            response_headers['Content-Range'] = f'bytes {start}-{end}/{len(body)}'
+            body = body[start:end+1]
+            status = (206, 'Partial Content')
+        else:
+            status = (200, 'OK')
+        response_headers['Content-Length'] = str(len(body))
+        return Response(*status, response_headers, body)
+
+    def process_request(self, conn, request):
+        """websockets process_request hook: answer requests which aren't websocket upgrades"""
+        if 'websocket' in request.headers.get('Upgrade', '').lower():
+            return None
+        return self.response(request)
+
+async def report_stats(interval):
+    """Periodically print statistics of the multiplexing upstreams"""
+    while True:
+        await asyncio.sleep(interval)
+        for name, upstream in upstreams.items():
+            stats = [f'{len(upstream.clients)} clients',
+                     f'{sum(c.superseded for c in upstream.clients)} superseded messages']
+            if upstream.cache is not None:
+                stats.append(f'persistent data cache {upstream.cache.hits} hits, {upstream.cache.misses} misses')
+            if upstream.scenes is not None:
+                stats.append(f'scene mirror {upstream.scenes.hits} hits, {upstream.scenes.misses} misses')
+            if upstream.screenshots is not None:
+                stats.append(f'screenshots {upstream.screenshots.requests} requests, {upstream.screenshots.merged} merged')
+            print(f"Stats{' ' + name if name else ''}: " + ', '.join(stats))
+
+async def main2(target_url, coordinator_sock=None):
+    """Run the proxy.
+
+    With --workers, this runs in each worker (handle() with
+    coordinator_socket set) and in the coordinator, which gets the
+    listening Unix socket `coordinator_sock`.
+    """
+    global recorder
+    handler = handle
+    targets[''] = target_url
+    for route in args.route:
+        name, url = route.split('=', 1)
+        targets[name] = url
+    for name, url in targets.items():
+        if not (url.startswith('ws://') or url.startswith('wss://')):
+            targets[name] = 'ws://' + url
+    if args.metrics and coordinator_socket is None:
+        for name in targets:
+            target_metrics[name] = Metrics()
+    if args.record and coordinator_socket is None:
+        recorder = Recorder(args.record, screenshots=args.record_screenshots)
+        asyncio.create_task(recorder.flush_periodically())
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit())   # so that the file is closed
+    if args.multiplex and coordinator_socket is None:
+        for name, url in targets.items():
+            cache = PersistentDataCache(args.cache_ttl) if args.cache_ttl > 0 else None
+            screenshots = ScreenshotCoalescer(args.screenshot_window) if args.screenshot_window > 0 else None
+            password = os.environ.get(f"OBS_PASSWORD_{name.upper().replace('-', '_')}", args.password)
+            journal_file = args.journal_file
+            if journal_file and name:
+                journal_file = f'{journal_file}.{name}'
+            upstreams[name] = Upstream(url, password=password, cache=cache, screenshots=screenshots,
+                                       max_bulk=args.max_bulk, max_state=args.max_state, metrics=target_metrics.get(name),
+                                       journal=Journal(args.journal_size, journal_file),
+                                       scenes=SceneMirror() if args.scene_mirror else None)
+            if name in target_metrics:
+                target_metrics[name].upstream = upstreams[name]
+        handler = handle_multiplexed
+        if args.stats_interval > 0:
+            asyncio.create_task(report_stats(args.stats_interval))
+    if target_metrics:
+        host, port = args.metrics.rsplit(':', 1)
+        await asyncio.start_server(serve_metrics, host, int(port))
+        print(f'Metrics on http://{args.metrics}/metrics')
+    compression = { }
+    if args.compression_level == 0:
+        compression['compression'] = None
+    else:
+        compression['extensions'] = [ServerPerMessageDeflateFactory(
+            server_max_window_bits=12,
+            client_max_window_bits=12,
+            compress_settings={'level': args.compression_level, 'memLevel': 5},
+            )]
+    if coordinator_sock is not None:
+        server = await websockets.unix_serve(
+            handler,
+            sock=coordinator_sock,
+            subprotocols=['obswebsocket.json'],
+            max_size=10*2**20,
+            compression=None,
+            )
+        print(f'Coordinator started for {args.workers} workers')
+        await server.serve_forever()
+        return
     server = await websockets.serve(
-        handle,
+        handler,
         *args.bind.rsplit(':', 1),
-        subprotocols=['obswebsocket.json'],
+        subprotocols=SUBPROTOCOLS,
         ssl=ssl_context,
         max_size=10*2**20,
+        reuse_port=bool(args.workers),
+        process_request=StaticFiles(args.web).process_request if args.web else None,
+        **compression,
         )
-    print(f'Server started on {args.bind}')
+    print(f'Server started on {args.bind}' + (f' (worker {os.getpid()})' if args.workers else ''))
     await server.serve_forever()
     print('Server closed')
 
@@ -193,19 +2085,159 @@ def main():
 
     If you have your own key/cert in some other location:
       websocket_proxy --cert=/path/to/fullchain.cer --key=/path/to/domain.key ...
+
+    MULTIPLEXING
+    ------------
+
+    By default each client gets its own connection to OBS, and the
+    clients authenticate to OBS themselves.  With --multiplex, the proxy
+    keeps one authenticated connection to OBS and all clients share it,
+    so the load on OBS doesn't depend on how many panels are open.  The
+    proxy then authenticates clients itself, with --client-password
+    (default: the same as --password).  If OBS restarts, clients stay
+    connected and their requests fail with NotReady (207) until the
+    proxy has reconnected.
+      websocket_proxy --multiplex --password=OBS_PASSWORD ...
+
+    Several OBS instances can be proxied by one process: connections to
+    /obs/NAME go to the --route NAME=URL target, all others to --obs.
+    With --multiplex, each target has its own shared connection, with
+    the password from the environment variable OBS_PASSWORD_NAME (NAME
+    upper-cased, - as _), or else --password.  Metrics are labeled with
+    obs=NAME (obs=default for --obs).
+      websocket_proxy --multiplex --route=backup=ws://10.0.0.2:4455 ...
+
+    With --multiplex, GetSceneList, GetSceneItemList and GetSceneItemId
+    are answered from the proxy's copy of the scenes, which it reads when
+    it connects and keeps up to date from events (--no-scene-mirror to
+    turn this off).
+
+    Clients which subscribe to InputVolumeMeters can add "meterRate": N
+    (per second) to their Identify, or call the SetMeterRate vendor
+    request of vendorName obs-cr-proxy, to get peak-held meters at that
+    rate instead of about 20/s.
+
+    The GetPersistentDataSnapshot vendor request (requestData "prefix",
+    and "slotNames" to include) returns all persistent data the proxy
+    knows of in one response, {"epoch": E, "seq": N, "slots": {name:
+    value}}: values it hasn't cached are read from OBS in one batch.
+    Every CustomEvent received after the response is newer than the
+    snapshot.  The proxy numbers each SetPersistentData and CustomEvent
+    (CustomEvents get their number in eventData "obsCrProxySeq") and
+    keeps the last --journal-size of them; after reconnecting, the
+    GetPersistentDataChanges vendor request (requestData "epoch" and
+    "seq" from the last response) returns {"epoch", "seq", "changes":
+    [{"seq", "type", "data": {name: value}}]}, or a snapshot like above
+    if some of those changes are no longer known.  With --journal-file,
+    changes are also kept in that file (NAME appended for --route
+    targets) across restarts.
+      websocket_proxy --multiplex --journal-file=/var/lib/obs-cr/journal ...
+
+    WEB PAGES
+    ---------
+
+    With --web, the proxy also serves the control pages (plain HTTP
+    requests on the same port), so tablets load them from the local
+    network instead of GitHub Pages.  Pages loaded this way connect to
+    the proxy that served them unless the URL has #url=...  Files are
+    read at startup and served precompressed (gzip, and brotli if the
+    brotli module is installed) with ETags; config.yaml is served as
+    JSON.  obs-websocket-js and js-yaml still come from their CDNs.
+      websocket_proxy --multiplex --web=web/ ...
+
+    BANDWIDTH
+    ---------
+
+    Clients can use the obswebsocket.msgpack subprotocol (if the msgpack
+    module is installed); OBS is always spoken to with JSON.  Messages
+    to clients which negotiate permessage-deflate (all browsers do) are
+    compressed.  Screenshots are base64 in both protocols, so msgpack
+    saves nothing on them, but deflate takes back most of the base64
+    overhead: JPEG screenshots get 23%% smaller.  Events and other small
+    messages are 23%% smaller with msgpack, and over 90%% smaller with
+    deflate, since they repeat a lot (python -m obs_cr.proxy_benchmark
+    prints the numbers).  Compression costs about 30 ms of CPU per MB
+    per client, at any level; use --compression-level=0 to turn it off
+    when the proxy runs on the same machine as the clients.
     """)
     parser = argparse.ArgumentParser(usage=usage)
     parser.add_argument('bind', nargs='?', default='0.0.0.0:4456',
                         help="local bind, format ADDRESS:PORT, default=%(default)s")
     parser.add_argument('--obs', default="ws://localhost:4455", dest='target',
                         help="OBS address to proxy to, default=%(default)s.  Must include ws:// or wss://")
+    parser.add_argument('--route', action='append', default=[ ], metavar='NAME=URL',
+                        help="Also proxy connections to /obs/NAME to the OBS at URL.  Can be given "
+                             "many times (see MULTIPLEXING above)")
     parser.add_argument('--ssl-domain', metavar='DOMAIN',
                         help="Automatically find acme.sh certs from ~/.acme.sh/DOMAIN_ecc/")
     parser.add_argument('--cert', help="Manual SSL .cer path")
     parser.add_argument('--key', help="Manual SSL .key path")
+    parser.add_argument('--multiplex', '-m', action='store_true',
+                        help="Share one OBS connection among all clients (see MULTIPLEXING above)")
+    parser.add_argument('--password', default=os.environ.get('OBS_PASSWORD'),
+                        help="OBS websocket password, used with --multiplex (default: env var OBS_PASSWORD)")
+    parser.add_argument('--client-password',
+                        help="Password clients must use with --multiplex, default: same as --password")
+    parser.add_argument('--cache-ttl', type=float, default=30, metavar='SECONDS',
+                        help="With --multiplex, answer GetPersistentData from a cache, and re-read "
+                             "values older than this from OBS.  0 disables the cache.  default=%(default)s")
+    parser.add_argument('--no-scene-mirror', dest='scene_mirror', action='store_false',
+                        help="With --multiplex, don't answer GetSceneList, GetSceneItemList and "
+                             "GetSceneItemId from the proxy's copy of the scenes")
+    parser.add_argument('--screenshot-window', type=float, default=0.1, metavar='SECONDS',
+                        help="With --multiplex, merge identical GetSourceScreenshot requests sent within "
+                             "this time of each other into one.  0 disables.  default=%(default)s")
+    parser.add_argument('--client-queue-mb', type=float, default=64, metavar='MB',
+                        help="With --multiplex, disconnect clients which fall this far behind, after "
+                             "dropping superseded screenshots and events.  default=%(default)s")
+    parser.add_argument('--max-bulk', type=int, default=2, metavar='N',
+                        help="With --multiplex, send at most N screenshot requests to OBS at a time, so "
+                             "that scene switches etc. don't wait behind them.  default=%(default)s")
+    parser.add_argument('--max-state', type=int, default=4, metavar='N',
+                        help="With --multiplex, send at most N other reads to OBS at a time, so that "
+                             "scene switches etc. go next.  default=%(default)s")
+    parser.add_argument('--journal-size', type=int, default=1000, metavar='N',
+                        help="With --multiplex, remember the last N persistent data changes for clients "
+                             "catching up after reconnecting.  default=%(default)s")
+    parser.add_argument('--journal-file', metavar='PATH',
+                        help="With --multiplex, also keep the persistent data changes in this file")
+    parser.add_argument('--workers', type=int, default=0, metavar='N',
+                        help="With --multiplex, run N worker processes for the client connections, "
+                             "sharing the OBS connections through a coordinator process.  default: "
+                             "one process")
+    parser.add_argument('--stats-interval', type=float, default=60, metavar='SECONDS',
+                        help="With --multiplex, print statistics this often.  0 disables.  default=%(default)s")
+    parser.add_argument('--rate-limit', action='append', default=[ ], metavar='TYPE=RATE[/BURST]',
+                        help="Limit each client to RATE requests/second of requestType TYPE, with bursts "
+                             "of BURST (default: RATE).  RATE 0 removes a limit.  Can be given many "
+                             "times.  Built-in limits: " +
+                             ', '.join(f'{t}={r}/{b}' for t, (r, b) in RATE_LIMITS.items()))
+    parser.add_argument('--web', metavar='DIR',
+                        help="Serve the files in DIR (the web/ directory of obs-cr) on the same port "
+                             "(see WEB PAGES above)")
+    parser.add_argument('--record', metavar='FILE',
+                        help="Append all client traffic to FILE (gzipped), for python -m obs_cr.proxy_replay")
+    parser.add_argument('--record-screenshots', action='store_true',
+                        help="With --record, keep screenshot image data instead of only its size")
+    parser.add_argument('--metrics', metavar='ADDRESS:PORT',
+                        help="Serve Prometheus metrics over HTTP here, for example 127.0.0.1:9456.  "
+                             "default: no metrics")
+    parser.add_argument('--compression-level', type=int, default=1, choices=range(10), metavar='0-9',
+                        help="zlib level of permessage-deflate to clients, 0 disables (see BANDWIDTH "
+                             "above).  default=%(default)s")
     parser.add_argument('--verbose', '-v', action='count', help="Increase verbosity")
     args = parser.parse_args()
     print(args.bind)
+    if args.workers and not args.multiplex:
+        parser.error('--workers needs --multiplex')
+    args.rate_limits = dict(RATE_LIMITS)
+    for limit in args.rate_limit:
+        requestType, rate = limit.split('=', 1)
+        rate, _, burst = rate.partition('/')
+        if float(rate) > 0:
+            args.rate_limits[requestType] = (float(rate), float(burst or rate))
+        else:
+            args.rate_limits.pop(requestType, None)
 
     ssl_context = None
     if args.ssl_domain:
@@ -219,7 +2251,53 @@ def main():
         ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
         ssl_context.load_cert_chain(certfile=args.cert, keyfile=args.key)
 
-    asyncio.run(main2(target_url=args.target))
+    if args.workers:
+        run_workers(args.workers)
+    else:
+        asyncio.run(main2(target_url=args.target))
+
+def run_workers(n):
+    """--workers: fork n workers, and run the coordinator in this process.
+
+    The workers all listen on the same port (SO_REUSEPORT, so the kernel
+    spreads connections over them) and do the per-client work: TLS,
+    compression, msgpack, filtering, rate limiting.  Each client gets a
+    connection over a Unix socket to the coordinator, which is the
+    --multiplex proxy: it has the one OBS session per target, the cache,
+    and the metrics.
+    """
+    global coordinator_socket
+    tmpdir = tempfile.mkdtemp(prefix='obs-proxy-')
+    path = os.path.join(tmpdir, 'coordinator.sock')
+    # Listen before forking, so that workers can connect right away.
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1024)
+    workers = [ ]
+    for _ in range(n):
+        pid = os.fork()
+        if pid == 0:
+            sock.close()
+            coordinator_socket = path
+            try:
+                asyncio.run(main2(target_url=args.target))
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        workers.append(pid)
+    # Workers limit their own clients, don't do it twice.
+    args.rate_limits = { }
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit())   # so that workers are stopped too
+    try:
+        asyncio.run(main2(target_url=args.target, coordinator_sock=sock))
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        shutil.rmtree(tmpdir, ignore_errors=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,241 @@
+import json
+
+import pytest
+
+from obs_cr.websocket_proxy import (Journal, _peek_match, filter_batch, filter_forwarded,
+                                    filter_returned, peek)
+
+
+def request(requestType, **d):
+    return json.dumps({'op': 6, 'd': dict(d, requestType=requestType, requestId='1')})
+
+
+# peek
+
+@pytest.mark.parametrize('message, path, value', [
+    ('{"op": 6, "d": {"requestType": "GetVersion"}}', ('d', 'requestType'), 'GetVersion'),
+    ('{"op":6}', ('op', ), 6),
+    ('{"d": {"requestId": -3}, "op": 6}', ('d', 'requestId'), -3),
+    ('{"d": {"requestId": "a\\"b"}}', ('d', 'requestId'), 'a"b'),
+    ('{"d": {"x": null}}', ('d', 'x'), None),
+    ('{"d": {}}', ('d', 'requestType'), None),
+    ])
+def test_peek(message, path, value):
+    assert peek(message, *path) == value
+
+
+@pytest.mark.parametrize('message', [
+    # The key twice: which one counts is up to the parser.
+    '{"d": {"requestType": "GetVersion", "requestType": "DeleteProfile"}}',
+    # The key in a value before the real one
+    '{"d": {"requestData": {"requestType": "GetVersion"}, "requestType": "DeleteProfile"}}',
+    # A \\u escape could spell another copy of the key
+    '{"d": {"requestType": "GetVersion", "request\\u0054ype": "DeleteProfile"}}',
+    # Containers aren't matched
+    '{"d": {"requestType": ["GetVersion"]}}',
+    ])
+def test_peek_match_untrusted(message):
+    assert _peek_match(message, 'requestType') is None
+
+
+def test_peek_match_trusted_escapes():
+    message = '{"d": {"requestType": "GetVersion", "comment": "\\u00e9"}}'
+    assert _peek_match(message, 'requestType') is None
+    assert _peek_match(message, 'requestType', trusted=True).group(1) == '"GetVersion"'
+
+
+def test_peek_parses_spoofs():
+    # Python's json, like OBS's, takes the last of duplicated keys.
+    assert peek('{"d": {"requestType": "GetVersion", "requestType": "DeleteProfile"}}',
+                'd', 'requestType') == 'DeleteProfile'
+    assert peek('{"d": {"requestType": "GetVersion", "request\\u0054ype": "DeleteProfile"}}',
+                'd', 'requestType') == 'DeleteProfile'
+    assert peek('{"d": {"op": 1}, "op": 6}', 'op') == 6
+
+
+# filter_forwarded
+
+def test_allowed_request_unchanged():
+    message = request('GetVersion')
+    assert filter_forwarded(message) is message
+
+
+def test_denied_request():
+    denied = [ ]
+    assert filter_forwarded(request('DeleteProfile'), deny=denied.append) is None
+    response = json.loads(denied[0])
+    assert response['op'] == 7
+    assert response['d']['requestId'] == '1'
+    assert response['d']['requestStatus'] == {
+        'result': False, 'code': 204, 'comment': 'requestType not allowed by proxy'}
+
+
+@pytest.mark.parametrize('message', [
+    '{"op": 6, "d": {"requestType": "GetVersion", "requestType": "DeleteProfile", "requestId": "1"}}',
+    '{"op": 6, "d": {"requestType": "GetVersion", "request\\u0054ype": "DeleteProfile", "requestId": "1"}}',
+    '{"op": 6, "d": {"requestData": {"requestType": "GetVersion"}, "requestType": "DeleteProfile", "requestId": "1"}}',
+    '{"op": 6, "d": {"requestType": "\\u0044eleteProfile", "requestId": "1"}}',
+    ])
+def test_spoofed_request_denied(message):
+    assert filter_forwarded(message) is None
+
+
+def test_spoofed_op():
+    # An op 6 posing as Identify is still checked as a request.
+    message = '{"d": {"op": 1, "requestType": "DeleteProfile", "requestId": "1"}, "op": 6}'
+    assert filter_forwarded(message) is None
+
+
+def test_input_settings_denied():
+    message = request('SetInputSettings', requestData={'inputName': 'x', 'inputSettings': {'url': 'x'}})
+    denied = [ ]
+    assert filter_forwarded(message, deny=denied.append) is None
+    assert json.loads(denied[0])['d']['requestStatus']['code'] == 400
+
+
+def test_batch_without_state_denied():
+    message = json.dumps({'op': 8, 'd': {'requestId': 'b', 'requests': [{'requestType': 'GetVersion'}]}})
+    assert filter_forwarded(message) is None
+
+
+# filter_batch
+
+def result(requestType, ok=True):
+    return {'requestType': requestType, 'requestStatus': {'result': ok, 'code': 100 if ok else 702}}
+
+
+def test_batch_allowed():
+    batch = {'requests': [{'requestType': 'GetVersion'}, {'requestType': 'GetSceneList'}]}
+    allowed_batch, complete = filter_batch(batch)
+    assert allowed_batch == batch
+    assert complete is None
+
+
+def test_batch_denied():
+    batch = {'requests': [{'requestType': 'GetVersion'}, {'requestType': 'DeleteProfile'},
+                          {'requestType': 'GetSceneList'}]}
+    allowed_batch, complete = filter_batch(batch)
+    assert [r['requestType'] for r in allowed_batch['requests']] == ['GetVersion', 'GetSceneList']
+    results = complete([result('GetVersion'), result('GetSceneList')])
+    assert [r['requestType'] for r in results] == ['GetVersion', 'DeleteProfile', 'GetSceneList']
+    assert results[1]['requestStatus']['code'] == 204
+
+
+def test_batch_denied_halt_on_failure():
+    batch = {'haltOnFailure': True,
+             'requests': [{'requestType': 'GetVersion'}, {'requestType': 'DeleteProfile'},
+                          {'requestType': 'SetCurrentProgramScene'}]}
+    allowed_batch, complete = filter_batch(batch)
+    # OBS would have stopped at the denied request.
+    assert [r['requestType'] for r in allowed_batch['requests']] == ['GetVersion']
+    assert allowed_batch['haltOnFailure'] is True
+    results = complete([result('GetVersion')])
+    assert [r['requestType'] for r in results] == ['GetVersion', 'DeleteProfile']
+    assert not results[1]['requestStatus']['result']
+
+
+def test_batch_halted_by_obs():
+    batch = {'haltOnFailure': True,
+             'requests': [{'requestType': 'GetVersion'}, {'requestType': 'SetCurrentProgramScene'},
+                          {'requestType': 'GetSceneList'}, {'requestType': 'DeleteProfile'}]}
+    allowed_batch, complete = filter_batch(batch)
+    assert len(allowed_batch['requests']) == 3
+    results = complete([result('GetVersion'), result('SetCurrentProgramScene', ok=False)])
+    assert [r['requestType'] for r in results] == ['GetVersion', 'SetCurrentProgramScene']
+
+
+def test_batch_all_denied():
+    batch = {'requests': [{'requestType': 'DeleteProfile'}, {'requestType': 'StopStream'}]}
+    allowed_batch, complete = filter_batch(batch)
+    # A harmless placeholder, so that OBS still answers
+    assert allowed_batch['requests'] == [{'requestType': 'GetVersion'}]
+    results = complete([result('GetVersion')])
+    assert [r['requestType'] for r in results] == ['DeleteProfile', 'StopStream']
+    assert not any(r['requestStatus']['result'] for r in results)
+
+
+def test_batch_spoofed_request_type():
+    message = ('{"op": 8, "d": {"requestId": "b", "requests": ['
+               '{"requestType": "GetVersion", "requestType": "DeleteProfile"}]}}')
+    batches = { }
+    forwarded = json.loads(filter_forwarded(message, batches))
+    assert forwarded['d']['requests'] == [{'requestType': 'GetVersion'}]   # the placeholder
+    response = json.dumps({'op': 9, 'd': {'requestId': 'b', 'results': [result('GetVersion')]}})
+    results = json.loads(filter_returned(response, batches))['d']['results']
+    assert [r['requestType'] for r in results] == ['DeleteProfile']
+    assert batches == { }
+
+
+# Journal
+
+def journal(size, n, path=None):
+    j = Journal(size, path)
+    for i in range(1, n + 1):
+        j.record('SetPersistentData', {'x': i})
+    return j
+
+
+def test_journal_since():
+    j = journal(5, 3)
+    assert j.since(3, j.epoch) == [ ]
+    assert j.since(1, j.epoch) == [{'seq': 2, 'type': 'SetPersistentData', 'data': {'x': 2}},
+                                   {'seq': 3, 'type': 'SetPersistentData', 'data': {'x': 3}}]
+    assert [c['seq'] for c in j.since(0, j.epoch)] == [1, 2, 3]
+
+
+def test_journal_since_gap():
+    j = journal(3, 10)
+    assert [c['seq'] for c in j.since(7, j.epoch)] == [8, 9, 10]
+    # Change 7 was forgotten
+    assert j.since(6, j.epoch) is None
+    assert j.since(0, j.epoch) is None
+
+
+def test_journal_since_unknown():
+    j = journal(3, 2)
+    assert j.since(1, 'other epoch') is None
+    assert j.since(5, j.epoch) is None   # from before a restart without a file
+
+
+def test_journal_size_zero():
+    j = journal(0, 2)
+    assert j.since(2, j.epoch) == [ ]
+    assert j.since(1, j.epoch) is None
+
+
+def test_journal_load(tmp_path):
+    path = tmp_path / 'journal'
+    j = journal(3, 5, path)
+    j.file.close()
+    j2 = Journal(3, path)
+    assert (j2.epoch, j2.seq) == (j.epoch, 5)
+    assert [c['seq'] for c in j2.since(2, j.epoch)] == [3, 4, 5]
+    j2.record('CustomEvent', {'y': 1})
+    j2.file.close()
+    # The file was trimmed to what is kept
+    assert len(path.read_text().splitlines()) == 1 + 4
+    assert Journal(3, path).seq == 6
+
+
+def test_journal_load_partial_line(tmp_path):
+    path = tmp_path / 'journal'
+    # More lines than the journal keeps
+    j = journal(3, 10, path)
+    j.file.write('[11, "SetPers')
+    j.file.close()
+    j2 = Journal(3, path)
+    assert (j2.epoch, j2.seq) == (j.epoch, 10)
+    assert [c['seq'] for c in j2.since(7, j.epoch)] == [8, 9, 10]
+
+
+def test_journal_load_corrupt(tmp_path):
+    path = tmp_path / 'journal'
+    j = journal(3, 5, path)
+    j.file.close()
+    lines = path.read_text().splitlines()
+    lines[2] = 'garbage'
+    path.write_text('\n'.join(lines) + '\n')
+    j2 = Journal(3, path)
+    assert j2.epoch != j.epoch
+    assert j2.seq == 0
+    assert j2.since(5, j.epoch) is None
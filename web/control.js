@@ -12,6 +12,7 @@ INIT_FUNCTIONS = [
     init_audio,
     obs_init,
     _obs_init_watchers,
+    obs_bootstrap,
     init_misc,
     init_sync_checkboxes,
     init_sync_buttons,
@@ -25,10 +25,13 @@ async function forEachAsync(querySelector, func) {
 }
 
 // Load global configuration
+SERVED_BY_PROXY = false;
 async function load_config () {
     response = await fetch("config.yaml").catch(update_status("Can not load config.yaml"))
     text = await response.text().catch(update_status("config.yaml data not loaded"))
-    CONFIG = jsyaml.load(text)
+    // websocket_proxy --web serves it already converted to JSON.
+    SERVED_BY_PROXY = (response.headers.get('Content-Type') || '').startsWith('application/json')
+    CONFIG = SERVED_BY_PROXY ? JSON.parse(text) : jsyaml.load(text)
     globalThis.CONFIG = CONFIG
     // Make mapping human name -> scene names
     CONFIG.SCENES_REVERSE = { }
@@ -319,6 +322,10 @@ async function copy_times() {
 async function obs_init () {
     const params = getFragmentParams();
     var url = params.url || 'localhost:4455';
+    if (! params.url && SERVED_BY_PROXY) {
+        // The proxy which served this page.
+        url = `${window.location.protocol == 'https:' ? 'wss' : 'ws'}://${window.location.host}`
+    }
     const password = params.password || '';
 
     if (! url.includes('//')) {
@@ -349,6 +356,9 @@ async function obs_init () {
                 60000);
     obs.on('ConnectionClosed', e => { obs_disconnected(e) } )
     obs.on('ConnectionError', e => { obs_disconnected(e) } )
+    if (PERSISTENT_SEQ !== undefined) {
+        await obs_catch_up();
+    }
 }
 
 async function obs_disconnected(e) {
@@ -400,6 +410,12 @@ async function obs_get(name) {
 }
 async function _obs_get(name) {
     if (OBS_DEBUG) {console.debug("_obs_get      ", name)}
+    if (name in PERSISTENT_SNAPSHOT) {
+        // Used once: afterwards, events keep the page up to date.
+        value = PERSISTENT_SNAPSHOT[name];
+        delete PERSISTENT_SNAPSHOT[name];
+        return value;
+    }
     x = await obs.call("GetPersistentData", {
         realm: "OBS_WEBSOCKET_DATA_REALM_PROFILE", 
         slotName: name});
@@ -436,7 +452,18 @@ async function _obs_trigger(name, value) {
     }
 }
 async function _obs_on_custom_event (data) {
+    if (PERSISTENT_SEQ_KEY in data) {
+        // Through the proxy: we have seen the changes up to this one.
+        if (PERSISTENT_SEQ !== undefined) {
+            PERSISTENT_SEQ = data[PERSISTENT_SEQ_KEY];
+        }
+        data = Object.assign({ }, data);
+        delete data[PERSISTENT_SEQ_KEY];
+    }
     for (name in data) {
+        if (name in PERSISTENT_SNAPSHOT) {
+            PERSISTENT_SNAPSHOT[name] = data[name];
+        }
         //console.log("C", name, data[name])
         await _obs_trigger(name, data[name])
     }
@@ -450,6 +477,75 @@ async function _obs_init_watchers() {
     await obs.on('InputVolumeChanged', event =>{_obs_trigger('volume-'+event.inputName, event.inputVolumeDb)});
 }
 
+// All persistent data in one request, if connected through obs-cr's
+// proxy with --multiplex.  The first obs_get of each name uses it
+// instead of a GetPersistentData round-trip.
+PERSISTENT_SNAPSHOT = { };
+PERSISTENT_EPOCH = undefined;
+PERSISTENT_SEQ = undefined;   // the proxy's last change we know of
+PERSISTENT_SEQ_KEY = 'obsCrProxySeq';   // its number in CustomEvents
+async function obs_bootstrap() {
+    try {
+        x = await obs.call('CallVendorRequest', {
+            vendorName: 'obs-cr-proxy',
+            requestType: 'GetPersistentDataSnapshot',
+            requestData: { }});
+        PERSISTENT_SNAPSHOT = x.responseData.slots;
+        PERSISTENT_EPOCH = x.responseData.epoch;
+        PERSISTENT_SEQ = x.responseData.seq;
+        if (OBS_DEBUG) {console.debug("obs_bootstrap", x.responseData.seq, PERSISTENT_SNAPSHOT)}
+    } catch (e) {
+        // Not the proxy (or without --multiplex): get values one by one.
+        if (OBS_DEBUG) {console.debug("obs_bootstrap: no snapshot", e)}
+    }
+}
+
+// After reconnecting: run the watchers of only what was set while we
+// were disconnected (or of everything, if the proxy doesn't know).
+// Broadcasts (obs_broadcast) that we missed aren't sent again.
+async function obs_catch_up() {
+    try {
+        x = await obs.call('CallVendorRequest', {
+            vendorName: 'obs-cr-proxy',
+            requestType: 'GetPersistentDataChanges',
+            requestData: {epoch: PERSISTENT_EPOCH, seq: PERSISTENT_SEQ,
+                          slotNames: Object.keys(WATCHERS)}});
+    } catch (e) {
+        console.log("obs_catch_up failed", e)
+        return
+    }
+    x = x.responseData;
+    if (OBS_DEBUG) {console.debug("obs_catch_up", PERSISTENT_SEQ, x)}
+    PERSISTENT_EPOCH = x.epoch;
+    PERSISTENT_SEQ = x.seq;
+    if (x.changes === undefined) {
+        // Watchers of events other than CustomEvents (mute-*, ...) have
+        // no stored value, so leave those alone.
+        PERSISTENT_SNAPSHOT = x.slots;
+        for (name in WATCHERS) {
+            if (window["obs_get_"+name] || (x.slots[name] ?? null) !== null) {
+                await obs_force(name);
+            }
+        }
+        PERSISTENT_SNAPSHOT = { };
+        return
+    }
+    // Only the last value of each matters.
+    changed = { };
+    for (change of x.changes) {
+        if (change.type == 'SetPersistentData') {
+            Object.assign(changed, change.data);
+        }
+    }
+    await _obs_on_custom_event(changed);
+    // Scene, mute, etc. aren't persistent data: get them again.
+    for (name in WATCHERS) {
+        if (window["obs_get_"+name]) {
+            await obs_force(name);
+        }
+    }
+}
+
 
 
 //